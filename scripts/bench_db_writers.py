@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Benchmark de escrituras concurrentes en SQLite: varios procesos (como workers
+de uvicorn) con varios hilos cada uno guardan facturas a la vez. Compara los
+valores por defecto de SQLite (SQLITE_TUNING=0) con el perfil de db.py (WAL,
+synchronous=NORMAL, mmap, busy_timeout y pool de conexiones).
+
+Cada perfil usa su propia BD temporal (journal_mode=WAL queda grabado en el
+archivo).
+
+Uso:
+    python scripts/bench_db_writers.py --workers 4 --threads 4 --invoices 100
+"""
+import argparse
+import atexit
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+RAW_TEXT = "FACTURA No FAC-{n}\nEMPRESA XYZ S.A.S\nNIT 900.123.456-7\n" + "Producto A    $100.000\n" * 60
+
+
+def writer_process(db_path, tuning, threads, invoices, ready, go, results):
+    """Proceso escritor: `threads` hilos guardando `invoices` facturas cada uno"""
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["SQLITE_TUNING"] = "1" if tuning else "0"
+    sys.path.insert(0, SRC)
+    from db import SessionLocal, Invoice
+
+    counts = {"ok": 0, "locked": 0}
+    lock = threading.Lock()
+
+    def worker(thread_id):
+        for i in range(invoices):
+            number = f"{os.getpid()}-{thread_id}-{i}"
+            db = SessionLocal()
+            try:
+                db.add(Invoice(
+                    invoice_number=number,
+                    supplier="EMPRESA XYZ S.A.S",
+                    total="$178.500",
+                    user_id=1,
+                    data_complete=f'{{"invoice_number": "{number}"}}',
+                    raw_text_ocr=RAW_TEXT.format(n=number),
+                ))
+                db.commit()
+                key = "ok"
+            except Exception as e:
+                db.rollback()
+                if "locked" not in str(e):
+                    raise
+                key = "locked"
+            finally:
+                db.close()
+            with lock:
+                counts[key] += 1
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    # Arrancar todos los procesos a la vez, ya con los imports hechos
+    ready.put(os.getpid())
+    go.wait()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    results.put(counts)
+
+
+def run_profile(label, tuning, args, tmpdir):
+    db_path = os.path.join(tmpdir, "tuned.db" if tuning else "default.db")
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", SQLITE_TUNING="1" if tuning else "0")
+    # Crear el esquema antes de lanzar los escritores
+    ctx = multiprocessing.get_context("spawn")
+    init = ctx.Process(target=_init_schema, args=(env,))
+    init.start()
+    init.join()
+
+    ready, go, results = ctx.Queue(), ctx.Event(), ctx.Queue()
+    procs = [
+        ctx.Process(target=writer_process, args=(db_path, tuning, args.threads, args.invoices, ready, go, results))
+        for _ in range(args.workers)
+    ]
+    for p in procs:
+        p.start()
+    for _ in procs:
+        ready.get()
+    start = time.perf_counter()
+    go.set()
+    counts = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    ok = sum(c["ok"] for c in counts)
+    locked = sum(c["locked"] for c in counts)
+    print(f"   {label:>11}: {ok / elapsed:7.1f} facturas/s | {ok} guardadas, {locked} 'database is locked' | {elapsed:.2f} s")
+    return ok / elapsed
+
+
+def _init_schema(env):
+    os.environ.update(env)
+    sys.path.insert(0, SRC)
+    from db import init_db
+    init_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de escritores concurrentes en SQLite")
+    parser.add_argument('--workers', type=int, default=4, help='Procesos escritores (workers de uvicorn)')
+    parser.add_argument('--threads', type=int, default=4, help='Hilos por proceso')
+    parser.add_argument('--invoices', type=int, default=100, help='Facturas por hilo')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_db_writers_")
+    atexit.register(shutil.rmtree, tmpdir, True)
+
+    print(
+        f"⏱️  Escrituras concurrentes: {args.workers} procesos x {args.threads} hilos x "
+        f"{args.invoices} facturas"
+    )
+    baseline = run_profile("por defecto", False, args, tmpdir)
+    tuned = run_profile("perfil WAL", True, args, tmpdir)
+    print(f"✅ Mejora: x{tuned / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
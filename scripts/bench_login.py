@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Benchmark de /api/login bajo carga concurrente: logins por segundo, latencia
+p50/p99 del login y latencia de /api/health mientras tanto (mide si el event
+loop queda bloqueado). Compara bcrypt en el pool auth_executor con bcrypt
+ejecutado en el propio event loop (comportamiento anterior).
+
+Usa una BD SQLite temporal y llama a la app en proceso (sin red).
+
+Uso:
+    python scripts/bench_login.py --requests 64 --concurrency 16 --rounds 12
+"""
+import argparse
+import asyncio
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import Executor, Future
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class InlineExecutor(Executor):
+    """Ejecuta la tarea en el hilo que la envía (simula bcrypt en el event loop)"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def measure(client, args):
+    """Lanza los logins y, en paralelo, sondea /api/health; devuelve métricas"""
+    credentials = {"username": "bench", "password": "bench-password"}
+    remaining = args.requests
+    login_latencies = []
+    health_latencies = []
+    done = asyncio.Event()
+
+    async def login_worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            resp = await client.post("/api/login", json=credentials)
+            resp.raise_for_status()
+            login_latencies.append(time.perf_counter() - start)
+
+    async def health_probe():
+        # La latencia se cuenta desde el instante en que tocaba enviar la
+        # petición, así un event loop bloqueado sí aparece en la medida
+        interval = 0.01
+        scheduled = time.perf_counter()
+        while not done.is_set():
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            await client.get("/api/health")
+            health_latencies.append(time.perf_counter() - scheduled)
+            scheduled = max(scheduled + interval, time.perf_counter())
+
+    probe = asyncio.create_task(health_probe())
+    start = time.perf_counter()
+    await asyncio.gather(*(login_worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await probe
+
+    return {
+        "rps": args.requests / elapsed,
+        "p50": percentile(login_latencies, 50),
+        "p99": percentile(login_latencies, 99),
+        "health_p99": percentile(health_latencies, 99) if health_latencies else float("nan"),
+    }
+
+
+async def run(args):
+    from src import chat_server
+    import httpx
+
+    transport = httpx.ASGITransport(app=chat_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        resp = await client.post("/api/register", json={"username": "bench", "password": "bench-password"})
+        resp.raise_for_status()
+
+        print(
+            f"⏱️  /api/login: {args.requests} peticiones, concurrencia {args.concurrency}, "
+            f"bcrypt rounds={chat_server.BCRYPT_ROUNDS}, AUTH_CONCURRENCY={chat_server.AUTH_CONCURRENCY}"
+        )
+        pool = chat_server.auth_executor
+        for label, executor in (("en el event loop", InlineExecutor()), ("auth_executor", pool)):
+            chat_server.auth_executor = executor
+            m = await measure(client, args)
+            print(
+                f"   {label:>16}: {m['rps']:6.1f} logins/s | login p50 {m['p50'] * 1000:6.0f} ms, "
+                f"p99 {m['p99'] * 1000:6.0f} ms | /api/health p99 {m['health_p99'] * 1000:6.0f} ms"
+            )
+        chat_server.auth_executor = pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de /api/login con bcrypt en pool vs en el event loop")
+    parser.add_argument('--requests', type=int, default=64, help='Logins por ronda')
+    parser.add_argument('--concurrency', type=int, default=16, help='Logins simultáneos')
+    parser.add_argument('--rounds', type=int, help='Coste de bcrypt (BCRYPT_ROUNDS)')
+    args = parser.parse_args()
+
+    # Configuración antes de importar la app: BD temporal y coste de bcrypt
+    tmpdir = tempfile.mkdtemp(prefix="bench_login_")
+    atexit.register(shutil.rmtree, tmpdir, True)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    if args.rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.rounds)
+    os.chdir(ROOT)  # la app sirve frontend/ con una ruta relativa
+    sys.path.insert(0, ROOT)
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
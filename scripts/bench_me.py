@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Microbenchmark de /api/me: peticiones por segundo con y sin la caché de
+usuarios autenticados. Usa una BD SQLite temporal y llama a la app en proceso
+(sin red), así que mide solo el coste del servidor.
+
+Uso:
+    python scripts/bench_me.py --requests 2000 --concurrency 20
+"""
+import argparse
+import asyncio
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# BD temporal para no tocar data/invoices.db (antes de importar la app)
+_tmpdir = tempfile.mkdtemp(prefix="bench_me_")
+atexit.register(shutil.rmtree, _tmpdir, True)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+os.chdir(ROOT)  # la app sirve frontend/ con una ruta relativa
+sys.path.insert(0, ROOT)
+
+import httpx
+
+from src import chat_server
+
+
+async def measure(client, requests_total, concurrency, headers):
+    """Lanza `requests_total` GET /api/me con `concurrency` en vuelo; devuelve req/s"""
+    remaining = requests_total
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            resp = await client.get("/api/me", headers=headers)
+            resp.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return requests_total / (time.perf_counter() - start)
+
+
+async def run(args):
+    transport = httpx.ASGITransport(app=chat_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        resp = await client.post("/api/register", json={"username": "bench", "password": "bench"})
+        resp.raise_for_status()
+        headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+
+        print(f"⏱️  /api/me: {args.requests} peticiones, concurrencia {args.concurrency}")
+        results = {}
+        for label, ttl in (("sin caché", 0), ("con caché", chat_server.USER_CACHE_TTL or 60)):
+            chat_server.user_cache = chat_server.UserCache(chat_server.USER_CACHE_SIZE, ttl)
+            await measure(client, min(200, args.requests), args.concurrency, headers)  # calentamiento
+            results[label] = await measure(client, args.requests, args.concurrency, headers)
+            print(f"   {label}: {results[label]:.0f} req/s")
+
+    print(f"✅ Mejora: x{results['con caché'] / results['sin caché']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de /api/me con y sin caché de usuarios")
+    parser.add_argument('--requests', type=int, default=2000, help='Peticiones por ronda')
+    parser.add_argument('--concurrency', type=int, default=20, help='Peticiones simultáneas')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
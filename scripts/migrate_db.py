@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 """
 Script para migrar la base de datos y añadir las nuevas columnas necesarias.
+
+Uso:
+    python scripts/migrate_db.py              # añade columnas/índices que falten
+    python scripts/migrate_db.py --backfill   # además recalcula las columnas tipadas
+    python scripts/migrate_db.py --no-vacuum  # no compacta el archivo tras mover textos
+    python scripts/migrate_db.py --reindex    # reconstruye el índice de búsqueda
 """
 import sys
 import os
@@ -8,8 +14,181 @@ import os
 # Agregar el directorio src al path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from db import engine, Base, Invoice, User
+from db import (
+    engine, Base, Invoice, User, BLOB_CODEC, SEARCH_TABLE, compress_text, decompress_text,
+    ensure_search_index, normalize_invoice_fields, rebuild_search_index, search_enabled,
+    search_table_sql, strip_raw_text,
+)
 from sqlalchemy import text
+from datetime import datetime
+import json
+
+# Filas por lote al rellenar las columnas tipadas de facturas existentes
+BACKFILL_BATCH_SIZE = 500
+# Filas por lote al mover los textos grandes a invoice_blobs
+BLOB_BATCH_SIZE = 200
+
+def move_texts_to_blobs(conn, existing_columns, batch_size=BLOB_BATCH_SIZE):
+    """
+    Mueve invoices.data_complete y invoices.raw_text_ocr (esquema anterior) a la
+    tabla invoice_blobs comprimidos con BLOB_CODEC, por lotes recorriendo por id.
+    De data_complete se quita raw_text, que duplicaba el texto OCR.
+    Devuelve el número de facturas movidas.
+    """
+    legacy = [c for c in ('data_complete', 'raw_text_ocr') if c in existing_columns]
+    if not legacy:
+        return 0
+    
+    print(f"📦 Moviendo {', '.join(legacy)} a invoice_blobs (codec {BLOB_CODEC})...")
+    data_expr = 'data_complete' if 'data_complete' in legacy else 'NULL'
+    raw_expr = 'raw_text_ocr' if 'raw_text_ocr' in legacy else 'NULL'
+    last_id = 0
+    moved = 0
+    while True:
+        rows = conn.execute(
+            text(
+                f"SELECT id, {data_expr}, {raw_expr} FROM invoices "
+                "WHERE id > :last_id ORDER BY id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": batch_size},
+        ).fetchall()
+        if not rows:
+            break
+        
+        params = [
+            {
+                "invoice_id": invoice_id,
+                "codec": BLOB_CODEC,
+                "data_complete_z": compress_text(BLOB_CODEC, strip_raw_text(data_complete)),
+                "raw_text_ocr_z": compress_text(BLOB_CODEC, raw_text_ocr),
+            }
+            for invoice_id, data_complete, raw_text_ocr in rows
+            if data_complete or raw_text_ocr
+        ]
+        if params:
+            # Si la factura ya tiene blob (migración repetida) se conserva
+            conn.execute(
+                text(
+                    "INSERT OR IGNORE INTO invoice_blobs (invoice_id, codec, data_complete_z, raw_text_ocr_z) "
+                    "VALUES (:invoice_id, :codec, :data_complete_z, :raw_text_ocr_z)"
+                ),
+                params,
+            )
+        conn.commit()
+        last_id = rows[-1][0]
+        moved += len(params)
+        print(f"   ... {moved} facturas movidas")
+    
+    # Quitar las columnas antiguas (DROP COLUMN requiere SQLite >= 3.35);
+    # si no se puede, al menos vaciarlas para que VACUUM libere el espacio
+    for column in legacy:
+        try:
+            conn.execute(text(f"ALTER TABLE invoices DROP COLUMN {column}"))
+            print(f"✓ Columna {column} eliminada de invoices")
+        except Exception as e:
+            conn.rollback()
+            conn.execute(text(f"UPDATE invoices SET {column} = NULL"))
+            print(f"⚠️  No se pudo eliminar {column} ({e}); se ha vaciado")
+        conn.commit()
+    
+    print(f"✓ Textos movidos a invoice_blobs ({moved} facturas)")
+    return moved
+
+def migrate_search_index(conn):
+    """
+    Crea el índice FTS5 de búsqueda y lo reconstruye si no cubre todas las
+    facturas (BD anterior a la búsqueda, o con --reindex) o si es una tabla FTS5
+    con copia propia del texto (versión anterior), que se sustituye por una
+    contentless. Devuelve True si se reconstruyó.
+    """
+    ensure_search_index(engine)
+    if not search_enabled():
+        return False
+    invoices = conn.execute(text("SELECT COUNT(*) FROM invoices")).scalar()
+    indexed = conn.execute(text(f"SELECT COUNT(*) FROM {SEARCH_TABLE}")).scalar()
+    stores_text = "content=''" not in search_table_sql(conn)
+    if indexed == invoices and not stores_text and '--reindex' not in sys.argv:
+        print(f"✓ Índice de búsqueda al día ({indexed} facturas)")
+        return False
+    if stores_text:
+        print("🔎 Sustituyendo el índice de búsqueda por uno sin copia del texto...")
+    else:
+        print(f"🔎 Construyendo índice de búsqueda ({indexed}/{invoices} facturas indexadas)...")
+    total = rebuild_search_index(conn)
+    print(f"✓ Índice de búsqueda construido ({total} facturas)")
+    return stores_text
+
+def vacuum():
+    """Compacta el archivo SQLite para devolver al sistema el espacio liberado"""
+    path = engine.url.database
+    size_before = os.path.getsize(path) if path and os.path.exists(path) else None
+    print("🧹 Compactando base de datos (VACUUM)...")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+        # En modo WAL el resultado queda en el -wal hasta el checkpoint
+        conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+    if size_before is not None:
+        size_after = os.path.getsize(path)
+        print(f"✓ Tamaño del archivo: {size_before / 1e6:.1f} MB → {size_after / 1e6:.1f} MB")
+
+def backfill_typed_columns(conn, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Rellena invoice_date, *_amount y currency de las facturas existentes a partir
+    de las columnas de texto y del JSON data_complete (en invoice_blobs), por
+    lotes (recorriendo por id) para no cargar toda la tabla ni mantener una
+    transacción larga.
+    """
+    print("🔄 Rellenando columnas tipadas de facturas existentes...")
+    last_id = 0
+    updated = 0
+    while True:
+        rows = conn.execute(
+            text(
+                "SELECT i.id, i.date, i.subtotal, i.tax, i.total, b.codec, b.data_complete_z "
+                "FROM invoices i LEFT JOIN invoice_blobs b ON b.invoice_id = i.id "
+                "WHERE i.id > :last_id ORDER BY i.id LIMIT :limit"
+            ),
+            {"last_id": last_id, "limit": batch_size},
+        ).fetchall()
+        if not rows:
+            break
+        
+        params = []
+        for invoice_id, date, subtotal, tax, total, codec, data_complete_z in rows:
+            data_complete = decompress_text(codec, data_complete_z) if codec else None
+            try:
+                data = json.loads(data_complete) if data_complete else {}
+            except json.JSONDecodeError:
+                data = {}
+            # Las columnas de texto tienen prioridad; el JSON completa lo que falte (moneda)
+            for key, value in (("date", date), ("subtotal", subtotal), ("tax", tax), ("total", total)):
+                if value:
+                    data[key] = value
+            fields = normalize_invoice_fields(data)
+            params.append({
+                "id": invoice_id,
+                "invoice_date": fields["invoice_date"].isoformat() if fields["invoice_date"] else None,
+                "subtotal_amount": str(fields["subtotal_amount"]) if fields["subtotal_amount"] is not None else None,
+                "tax_amount": str(fields["tax_amount"]) if fields["tax_amount"] is not None else None,
+                "total_amount": str(fields["total_amount"]) if fields["total_amount"] is not None else None,
+                "currency": fields["currency"],
+            })
+        
+        conn.execute(
+            text(
+                "UPDATE invoices SET invoice_date = :invoice_date, subtotal_amount = :subtotal_amount, "
+                "tax_amount = :tax_amount, total_amount = :total_amount, currency = :currency "
+                "WHERE id = :id"
+            ),
+            params,
+        )
+        conn.commit()
+        last_id = rows[-1][0]
+        updated += len(rows)
+        print(f"   ... {updated} facturas procesadas")
+    
+    print(f"✓ Columnas tipadas rellenadas ({updated} facturas)")
+
 
 def migrate():
     """Migra la base de datos añadiendo las nuevas columnas"""
@@ -34,23 +213,75 @@ def migrate():
             conn.execute(text("CREATE INDEX IF NOT EXISTS idx_invoices_user_id ON invoices(user_id)"))
             print("✓ Columna user_id añadida")
         
-        if 'data_complete' not in existing_columns:
-            print("➕ Añadiendo columna data_complete...")
-            conn.execute(text("ALTER TABLE invoices ADD COLUMN data_complete TEXT"))
-            print("✓ Columna data_complete añadida")
-        
-        if 'raw_text_ocr' not in existing_columns:
-            print("➕ Añadiendo columna raw_text_ocr...")
-            conn.execute(text("ALTER TABLE invoices ADD COLUMN raw_text_ocr TEXT"))
-            print("✓ Columna raw_text_ocr añadida")
-        
         if 'created_at' not in existing_columns:
             print("➕ Añadiendo columna created_at...")
             conn.execute(text("ALTER TABLE invoices ADD COLUMN created_at DATETIME"))
             conn.execute(text("CREATE INDEX IF NOT EXISTS idx_invoices_created_at ON invoices(created_at)"))
             print("✓ Columna created_at añadida")
         
+        # Columnas tipadas (fecha, montos y moneda) para consultas en SQL
+        typed_columns = [
+            ('invoice_date', 'DATE'),
+            ('subtotal_amount', 'NUMERIC(14, 2)'),
+            ('tax_amount', 'NUMERIC(14, 2)'),
+            ('total_amount', 'NUMERIC(14, 2)'),
+            ('currency', 'VARCHAR(3)'),
+        ]
+        added_typed = False
+        for name, sql_type in typed_columns:
+            if name not in existing_columns:
+                print(f"➕ Añadiendo columna {name}...")
+                conn.execute(text(f"ALTER TABLE invoices ADD COLUMN {name} {sql_type}"))
+                print(f"✓ Columna {name} añadida")
+                added_typed = True
+        
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_invoices_user_date ON invoices(user_id, invoice_date)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_invoices_user_supplier ON invoices(user_id, supplier)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_invoices_user_created ON invoices(user_id, created_at, id)"))
+        print("✓ Índices (user_id, invoice_date), (user_id, supplier) y (user_id, created_at, id) verificados")
+        
+        # El listado paginado ordena por (created_at, id): las facturas antiguas
+        # sin created_at se fechan como las más viejas para no quedar fuera
+        missing = conn.execute(text("SELECT COUNT(*) FROM invoices WHERE created_at IS NULL")).scalar()
+        if missing:
+            oldest = conn.execute(text("SELECT MIN(created_at) FROM invoices")).scalar()
+            conn.execute(
+                text("UPDATE invoices SET created_at = :oldest WHERE created_at IS NULL"),
+                {"oldest": oldest or datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")},
+            )
+            print(f"✓ created_at asignado a {missing} facturas antiguas")
+        # Mismo formato de texto que escribe SQLAlchemy (con microsegundos), si
+        # no la comparación con el cursor del listado no es correcta
+        fixed = conn.execute(
+            text("UPDATE invoices SET created_at = created_at || '.000000' WHERE length(created_at) = 19")
+        ).rowcount
+        if fixed:
+            print(f"✓ Formato de created_at normalizado en {fixed} facturas")
+        
+        conn.commit()
+        
+        # Concesiones de la cola de trabajos (proceso dueño, vencimiento e intentos)
+        job_columns = [row[1] for row in conn.execute(text("PRAGMA table_info(invoice_jobs)"))]
+        for name, sql_type in (
+            ('worker_id', 'VARCHAR'),
+            ('lease_until', 'DATETIME'),
+            ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ):
+            if name not in job_columns:
+                conn.execute(text(f"ALTER TABLE invoice_jobs ADD COLUMN {name} {sql_type}"))
+                print(f"✓ Columna invoice_jobs.{name} añadida")
         conn.commit()
+        
+        # data_complete y raw_text_ocr viven ahora comprimidos en invoice_blobs
+        moved = move_texts_to_blobs(conn, existing_columns)
+        
+        if added_typed or '--backfill' in sys.argv:
+            backfill_typed_columns(conn)
+        
+        reindexed = migrate_search_index(conn)
+    
+    if (moved or reindexed) and '--no-vacuum' not in sys.argv:
+        vacuum()
     
     print("\n✅ Migración completada exitosamente")
     print("La base de datos ahora tiene todas las columnas necesarias.")
@@ -8,7 +8,7 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from ocr_utils import ocr_file
 from extractor import extract_invoice_data
-from db import SessionLocal, Invoice, init_db
+from db import SessionLocal, Invoice, count_invoices, init_db, list_invoices, normalize_invoice_fields
 from local_ai_agent import refinar_datos_factura
 import streamlit.components.v1 as components
 
@@ -109,7 +109,8 @@ if uploaded is not None:
                     date=datos_descarga.get('date'),
                     subtotal=datos_descarga.get('subtotal'),
                     tax=datos_descarga.get('tax'),
-                    total=datos_descarga.get('total')
+                    total=datos_descarga.get('total'),
+                    **normalize_invoice_fields(datos_descarga)
                 )
                 db.add(invoice)
                 db.commit()
@@ -149,12 +150,14 @@ st.sidebar.markdown("""
 st.sidebar.header("📚 Facturas en BD")
 try:
     db = SessionLocal()
-    invoices = db.query(Invoice).all()
-    db.close()
-    st.sidebar.write(f"Total: {len(invoices)} facturas")
-    if invoices:
-        for inv in invoices[-5:]:  # Últimas 5
-            st.sidebar.text(f"• {inv.invoice_number or 'N/A'}")
+    try:
+        total = count_invoices(db)
+        recientes, _ = list_invoices(db, limit=5)  # Últimas 5, sin cargar la tabla
+    finally:
+        db.close()
+    st.sidebar.write(f"Total: {total} facturas")
+    for inv in recientes:
+        st.sidebar.text(f"• {inv['invoice_number'] or 'N/A'}")
 except:
     st.sidebar.write("BD no inicializada")
 
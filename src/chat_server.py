@@ -1,22 +1,53 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from functools import partial
+import asyncio
 import bcrypt
 import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
 
-from .ocr_utils import ocr_file
+from .ocr_utils import OCR_WORKERS, ocr_file, sniff_suffix
 from .extractor import extract_invoice_data
-from .db import SessionLocal, Invoice, User, init_db
+from .db import (
+    SessionLocal,
+    Invoice,
+    InvoiceBlob,
+    InvoiceJob,
+    User,
+    decompress_text,
+    count_invoices,
+    init_db,
+    list_invoices,
+    normalize_invoice_fields,
+    search_invoices,
+    spend_by_supplier_month,
+    strip_raw_text,
+)
 from .local_ai_agent import (
-    extraer_datos_con_ia,
-    refinar_datos_factura,
-    responder_pregunta_sobre_factura,
+    LocalAIAgentError,
+    aclose_async_client,
+    extraer_datos_con_ia_async,
+    refinar_datos_factura_async,
+    responder_pregunta_sobre_factura_async,
+    responder_pregunta_sobre_factura_stream,
 )
 
 
@@ -29,6 +60,85 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 horas
 
 security = HTTPBearer()
 
+# Límites de concurrencia por etapa. El trabajo bloqueante nunca corre en el
+# event loop: OCR y extracción clásica (CPU) en un pool de procesos y las
+# consultas a la BD en un pool de hilos. Las llamadas al LLM son asíncronas
+# (cliente HTTP con keep-alive) y se limitan con un semáforo.
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "2"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+DB_CONCURRENCY = int(os.getenv("DB_CONCURRENCY", "8"))
+# Hash de contraseñas (bcrypt, CPU y libera el GIL): pool de hilos propio para
+# que una ráfaga de logins no ocupe los hilos de BD, y coste configurable
+AUTH_CONCURRENCY = int(os.getenv("AUTH_CONCURRENCY", str(os.cpu_count() or 2)))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# Trabajos asíncronos: número de facturas que se procesan a la vez y carpeta donde
+# se conservan los archivos subidos hasta que su trabajo termina
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join("data", "jobs"))
+# Concesión de un trabajo en curso: el proceso que lo ejecuta la renueva cada
+# JOB_LEASE_SECONDS / 3; si vence (proceso caído) otro proceso lo reencola, hasta
+# JOB_MAX_ATTEMPTS veces para no reintentar sin fin un trabajo que tumba el proceso
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Los trabajos terminados ('done'/'error') se borran pasado este tiempo
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "168"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Subidas de facturas: tamaño máximo y tamaño de bloque al copiarlas a disco
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "25")) * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_PATHS = ("/api/process-invoice", "/api/jobs")
+SUPPORTED_UPLOAD_SUFFIXES = ('.pdf', '.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif', '.webp')
+
+# Caché en memoria de usuarios autenticados (nombre -> usuario)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+# Caché en memoria del historial de facturas por usuario (contexto del LLM)
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "256"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "300"))
+
+# Máximo de resultados por búsqueda en /api/invoices/search
+SEARCH_MAX_RESULTS = 50
+# Máximo de facturas por página en /api/invoices
+LIST_MAX_LIMIT = 100
+
+# Hilos de páginas dentro de cada proceso de OCR: entre todos los procesos no
+# se pasa de OCR_WORKERS (cada hilo lanza su propio tesseract)
+OCR_PAGE_WORKERS = int(os.getenv("OCR_PAGE_WORKERS", str(max(1, OCR_WORKERS // OCR_CONCURRENCY))))
+
+ocr_executor = ProcessPoolExecutor(max_workers=OCR_CONCURRENCY)
+db_executor = ThreadPoolExecutor(max_workers=DB_CONCURRENCY, thread_name_prefix="db")
+auth_executor = ThreadPoolExecutor(max_workers=AUTH_CONCURRENCY, thread_name_prefix="auth")
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+
+async def run_blocking(executor, func, *args, **kwargs):
+    """Ejecuta una función bloqueante en `executor` sin bloquear el event loop"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+    except BrokenProcessPool:
+        # Un proceso de OCR murió (segfault de tesserocr, OOM...): el pool queda
+        # inservible, así que se sustituye por uno nuevo para las siguientes tareas
+        _replace_broken_ocr_executor(executor)
+        raise
+
+
+def _replace_broken_ocr_executor(broken: ProcessPoolExecutor) -> None:
+    global ocr_executor
+    if broken is ocr_executor:
+        print("⚠️ El pool de OCR se rompió (murió un proceso); se crea uno nuevo")
+        ocr_executor = ProcessPoolExecutor(max_workers=OCR_CONCURRENCY)
+        broken.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_llm(func, *args, **kwargs):
+    """Ejecuta una llamada asíncrona al LLM respetando LLM_CONCURRENCY"""
+    async with llm_semaphore:
+        return await func(*args, **kwargs)
+
 
 class ChatRequest(BaseModel):
     question: str
@@ -53,12 +163,12 @@ class TokenResponse(BaseModel):
 
 
 def hash_password(password: str) -> str:
-    """Hashea una contraseña usando bcrypt"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    """Hashea una contraseña usando bcrypt (bloqueante: usar desde auth_executor)"""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verifica una contraseña contra su hash"""
+    """Verifica una contraseña contra su hash (bloqueante: usar desde auth_executor)"""
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 
@@ -74,6 +184,57 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+def get_user_by_username(username: str) -> Optional[User]:
+    """Busca un usuario por nombre (bloqueante: usar desde db_executor)"""
+    db = SessionLocal()
+    try:
+        return db.query(User).filter(User.username == username).first()
+    finally:
+        db.close()
+
+
+class UserCache:
+    """
+    Caché LRU en memoria de nombre de usuario -> usuario (desligado de la
+    sesión) con TTL corto, para no consultar la BD en cada petición autenticada.
+    Solo se cachean usuarios existentes. Un TTL de 0 desactiva la caché.
+    """
+
+    def __init__(self, max_users: int, ttl: float):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, User]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[username]
+                return None
+            self._entries.move_to_end(username)
+            return entry[1]
+
+    def put(self, username: str, user: User) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[username] = (time.monotonic(), user)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        """Olvida un usuario (llamar al registrarlo o al cambiar su cuenta)"""
+        with self._lock:
+            self._entries.pop(username, None)
+
+
+user_cache = UserCache(max_users=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Dependencia para obtener el usuario actual desde el token JWT"""
     credentials_exception = HTTPException(
@@ -90,11 +251,13 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except JWTError:
         raise credentials_exception
     
-    db = SessionLocal()
-    user = db.query(User).filter(User.username == username).first()
-    db.close()
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    user = await run_blocking(db_executor, get_user_by_username, username)
     if user is None:
         raise credentials_exception
+    user_cache.put(username, user)
     return user
 
 
@@ -102,7 +265,26 @@ class ChatResponse(BaseModel):
     answer: str
 
 
-app = FastAPI(title="Intelli-Invoice Chat Server")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Arrancar los trabajadores de la cola y reencolar lo pendiente de antes del reinicio
+    global job_queue
+    job_queue = asyncio.Queue()
+    workers = [asyncio.create_task(job_worker()) for _ in range(JOB_WORKERS)]
+    workers.append(asyncio.create_task(job_reaper()))
+    yield
+    for worker in workers:
+        worker.cancel()
+    # Esperar a que los trabajos interrumpidos vuelvan a la cola antes de cerrar el pool de BD
+    await asyncio.gather(*workers, return_exceptions=True)
+    # Apagar los pools al cerrar el servidor
+    await aclose_async_client()
+    ocr_executor.shutdown(wait=False, cancel_futures=True)
+    db_executor.shutdown(wait=False, cancel_futures=True)
+    auth_executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="Intelli-Invoice Chat Server", lifespan=lifespan)
 
 origins = [
     "http://localhost",
@@ -111,6 +293,48 @@ origins = [
     "http://127.0.0.1:8501",
 ]
 
+class UploadLimitMiddleware:
+    """
+    Rechaza con 413 las subidas mayores que MAX_UPLOAD_BYTES antes de leerlas:
+    por Content-Length si viene, o al superar el límite mientras llega el cuerpo.
+    """
+
+    def __init__(self, app, max_bytes: int, paths):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        # El multipart añade cabeceras y separadores: margen de 64 KB sobre el archivo
+        limit = self.max_bytes + 64 * 1024
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse(status_code=413, content={"detail": _too_large_detail(self.max_bytes)})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=_too_large_detail(self.max_bytes))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def _too_large_detail(max_bytes: int) -> str:
+    return f"Archivo demasiado grande (máximo {max_bytes // (1024 * 1024)} MB)"
+
+
+app.add_middleware(UploadLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES, paths=UPLOAD_PATHS)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -120,64 +344,63 @@ app.add_middleware(
 )
 
 
-@app.post("/api/register", response_model=TokenResponse)
-async def register(req: RegisterRequest):
-    """Registra un nuevo usuario"""
+def create_user(username: str, password_hash: str) -> bool:
+    """Crea un usuario; False si el nombre ya existe (bloqueante: usar desde db_executor)"""
     db = SessionLocal()
     try:
-        # Verificar si el usuario ya existe
-        existing_user = db.query(User).filter(User.username == req.username).first()
-        if existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="El nombre de usuario ya existe"
-            )
-        
-        # Crear nuevo usuario
-        password_hash = hash_password(req.password)
-        new_user = User(username=req.username, password_hash=password_hash)
-        db.add(new_user)
+        db.add(User(username=username, password_hash=password_hash))
         db.commit()
-        
-        # Crear token
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": req.username}, expires_delta=access_token_expires
-        )
-        
-        return TokenResponse(
-            access_token=access_token,
-            token_type="bearer",
-            username=req.username
-        )
+        return True
+    except IntegrityError:
+        db.rollback()
+        return False
     finally:
         db.close()
 
 
+def _token_response(username: str) -> TokenResponse:
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data={"sub": username}, expires_delta=access_token_expires
+    )
+    return TokenResponse(
+        access_token=access_token,
+        token_type="bearer",
+        username=username
+    )
+
+
+@app.post("/api/register", response_model=TokenResponse)
+async def register(req: RegisterRequest):
+    """Registra un nuevo usuario"""
+    username_taken = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="El nombre de usuario ya existe"
+    )
+    # Verificar si el usuario ya existe (evita hashear en vano)
+    if await run_blocking(db_executor, get_user_by_username, req.username):
+        raise username_taken
+
+    # Crear nuevo usuario (la restricción UNIQUE resuelve registros simultáneos)
+    password_hash = await run_blocking(auth_executor, hash_password, req.password)
+    if not await run_blocking(db_executor, create_user, req.username, password_hash):
+        raise username_taken
+    user_cache.invalidate(req.username)
+
+    return _token_response(req.username)
+
+
 @app.post("/api/login", response_model=TokenResponse)
 async def login(req: LoginRequest):
     """Inicia sesión y devuelve un token JWT"""
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.username == req.username).first()
-        if not user or not verify_password(req.password, user.password_hash):
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Nombre de usuario o contraseña incorrectos"
-            )
-        
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user.username}, expires_delta=access_token_expires
+    user = await run_blocking(db_executor, get_user_by_username, req.username)
+    if not user or not await run_blocking(auth_executor, verify_password, req.password, user.password_hash):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Nombre de usuario o contraseña incorrectos"
         )
-        
-        return TokenResponse(
-            access_token=access_token,
-            token_type="bearer",
-            username=user.username
-        )
-    finally:
-        db.close()
+
+    return _token_response(user.username)
 
 
 @app.get("/api/me")
@@ -186,51 +409,118 @@ async def get_current_user_info(current_user: User = Depends(get_current_user)):
     return {"username": current_user.username, "id": current_user.id}
 
 
+class UserHistoryCache:
+    """
+    Caché LRU en memoria del historial de facturas por usuario, con TTL corto.
+    Se invalida al guardar una factura del usuario; el TTL cubre las escrituras
+    hechas desde otros procesos (otros workers, Streamlit o la CLI).
+    """
+
+    def __init__(self, max_users: int, ttl: float):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[float, int, List[Dict[str, Any]]]]" = OrderedDict()
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            stored_at, stored_limit, history = entry
+            if time.monotonic() - stored_at > self.ttl or (limit > stored_limit and len(history) == stored_limit):
+                return None
+            self._entries.move_to_end(user_id)
+            return history[:limit]
+
+    def generation(self, user_id: int) -> int:
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def put(self, user_id: int, limit: int, history: List[Dict[str, Any]], generation: int) -> None:
+        """Guarda el historial salvo que se haya invalidado mientras se consultaba"""
+        with self._lock:
+            if self._generations.get(user_id, 0) != generation:
+                return
+            self._entries[user_id] = (time.monotonic(), limit, history)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+
+history_cache = UserHistoryCache(max_users=HISTORY_CACHE_USERS, ttl=HISTORY_CACHE_TTL)
+
+
 def get_user_invoice_history(user_id: int, limit: int = 5) -> List[Dict[str, Any]]:
     """
     Obtiene las últimas facturas procesadas por el usuario para usar como contexto.
     Esto permite que el modelo 'aprenda' de facturas anteriores del mismo usuario.
     """
+    cached = history_cache.get(user_id, limit)
+    if cached is not None:
+        return cached
+
+    generation = history_cache.generation(user_id)
     db = SessionLocal()
     try:
-        invoices = db.query(Invoice).filter(
+        # Solo las columnas que se usan como contexto
+        rows = db.query(
+            Invoice.invoice_number,
+            Invoice.supplier,
+            Invoice.date,
+            Invoice.created_at,
+            InvoiceBlob.codec,
+            InvoiceBlob.data_complete_z,
+            InvoiceBlob.raw_text_ocr_z,
+        ).outerjoin(
+            InvoiceBlob, InvoiceBlob.invoice_id == Invoice.id
+        ).filter(
             Invoice.user_id == user_id
         ).order_by(Invoice.created_at.desc()).limit(limit).all()
-        
-        history = []
-        for inv in invoices:
-            try:
-                data = json.loads(inv.data_complete) if inv.data_complete else {}
-            except:
-                data = {}
-            # Asegurar que el raw_text esté en los datos
-            if inv.raw_text_ocr and 'raw_text' not in data:
-                data['raw_text'] = inv.raw_text_ocr
-            history.append({
-                "invoice_number": inv.invoice_number,
-                "supplier": inv.supplier,
-                "date": inv.date,
-                "data": data,
-                "raw_text_ocr": inv.raw_text_ocr or "",
-                "created_at": inv.created_at.isoformat() if inv.created_at else None,
-            })
-        return history
     finally:
         db.close()
 
+    history = []
+    for invoice_number, supplier, date, created_at, codec, data_complete_z, raw_text_ocr_z in rows:
+        data_complete = decompress_text(codec, data_complete_z)
+        raw_text_ocr = decompress_text(codec, raw_text_ocr_z)
+        try:
+            data = json.loads(data_complete) if data_complete else {}
+        except json.JSONDecodeError:
+            data = {}
+        # El texto OCR se guarda una sola vez, en raw_text_ocr
+        if raw_text_ocr:
+            data.pop('raw_text', None)
+        history.append({
+            "invoice_number": invoice_number,
+            "supplier": supplier,
+            "date": date,
+            "data": data,
+            "raw_text_ocr": raw_text_ocr or "",
+            "created_at": created_at.isoformat() if created_at else None,
+        })
+    history_cache.put(user_id, limit, history, generation)
+    return history
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(
-    req: ChatRequest,
-    current_user: User = Depends(get_current_user)
-):
+
+NO_INVOICES_ANSWER = (
+    "No tienes facturas procesadas aún. Por favor, sube y procesa una factura primero para poder hacer preguntas."
+)
+
+
+async def build_chat_context(req: ChatRequest, user: User) -> Optional[Dict[str, Any]]:
     """
-    Endpoint que usa la IA local para responder preguntas sobre facturas.
-    Puede responder sobre la factura actual procesada o sobre facturas anteriores del usuario.
-    Requiere autenticación y conoce el usuario actual.
+    Argumentos para responder_pregunta_sobre_factura*: la factura actual si se
+    envía, o si no las facturas más recientes del usuario. None si no hay ninguna.
     """
     # Obtener historial de facturas del usuario para contexto
-    historial = get_user_invoice_history(current_user.id, limit=5)
+    historial = await run_blocking(db_executor, get_user_invoice_history, user.id, limit=5)
     
     # Determinar qué datos usar para el contexto
     if req.raw_text and req.data_structured:
@@ -257,27 +547,244 @@ async def chat(
         }
     else:
         # No hay facturas disponibles
-        return ChatResponse(
-            answer="No tienes facturas procesadas aún. Por favor, sube y procesa una factura primero para poder hacer preguntas."
-        )
+        return None
     
     # Modificar la pregunta para incluir el contexto del usuario
-    pregunta_con_usuario = f"[Usuario: {current_user.username}] {req.question}"
+    pregunta_con_usuario = f"[Usuario: {user.username}] {req.question}"
     
-    answer = responder_pregunta_sobre_factura(
-        raw_text=raw_text,
-        data_estructurada=data_estructurada,
-        pregunta=pregunta_con_usuario,
-        historial_usuario=historial if historial else None,
-    )
+    return {
+        "raw_text": raw_text,
+        "data_estructurada": data_estructurada,
+        "pregunta": pregunta_con_usuario,
+        "historial_usuario": historial if historial else None,
+    }
+
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(
+    req: ChatRequest,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Endpoint que usa la IA local para responder preguntas sobre facturas.
+    Puede responder sobre la factura actual procesada o sobre facturas anteriores del usuario.
+    Requiere autenticación y conoce el usuario actual.
+    """
+    context = await build_chat_context(req, current_user)
+    if context is None:
+        return ChatResponse(answer=NO_INVOICES_ANSWER)
+
+    answer = await run_llm(responder_pregunta_sobre_factura_async, **context)
     return ChatResponse(answer=answer)
 
 
+def _sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Formatea un evento server-sent events con datos JSON"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(
+    req: ChatRequest,
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Igual que /api/chat pero devuelve la respuesta como server-sent events a
+    medida que el modelo la genera: eventos `data: {"delta": "..."}`, y al
+    final `event: done` (o `event: error` con `detail`). Si el cliente se
+    desconecta se deja de generar.
+    """
+    context = await build_chat_context(req, current_user)
+
+    async def events():
+        if context is None:
+            yield _sse({"delta": NO_INVOICES_ANSWER})
+            yield _sse({}, event="done")
+            return
+
+        async with llm_semaphore:
+            stream = responder_pregunta_sobre_factura_stream(**context)
+            try:
+                async for chunk in stream:
+                    if await request.is_disconnected():
+                        return
+                    yield _sse({"delta": chunk})
+                yield _sse({}, event="done")
+            except LocalAIAgentError as e:
+                yield _sse({"detail": str(e)}, event="error")
+            finally:
+                # Cierra la conexión con LM Studio (detiene la generación si no terminó)
+                await stream.aclose()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def save_invoice(user: User, datos: Dict[str, Any], raw_text: str) -> Optional[int]:
+    """
+    Guarda una factura procesada asociada al usuario y devuelve su id, o None
+    si no se pudo guardar (bloqueante: usar desde db_executor)
+    """
+    try:
+        db = SessionLocal()
+        invoice = Invoice(
+            user_id=user.id,
+            invoice_number=str(datos.get("invoice_number") or ""),
+            supplier=str(datos.get("supplier") or ""),
+            nit=str(datos.get("nit") or ""),
+            date=str(datos.get("date") or ""),
+            subtotal=str(datos.get("subtotal") or ""),
+            tax=str(datos.get("tax") or ""),
+            total=str(datos.get("total") or ""),
+            data_complete=strip_raw_text(datos),
+            raw_text_ocr=raw_text,
+            **normalize_invoice_fields(datos),
+        )
+        db.add(invoice)
+        db.commit()
+        invoice_id = invoice.id
+        db.close()
+        history_cache.invalidate(user.id)
+        print(f"✓ Factura guardada en BD para usuario {user.username}")
+        return invoice_id
+    except Exception as e:
+        print(f"⚠️ Error guardando en BD: {e}")
+        return None
+
+
 class ProcessInvoiceResponse(BaseModel):
     raw_text: str
     data_initial: Dict[str, Any]
     data_refined: Optional[Dict[str, Any]] = None
     saved_to_db: bool = False
+    invoice_id: Optional[int] = None
+
+
+async def run_invoice_pipeline(path: str, user: User, refine: bool = True, on_stage=None) -> ProcessInvoiceResponse:
+    """
+    OCR + extracción con IA + extracción clásica + refinamiento + guardado en BD.
+
+    `on_stage(etapa, estado, segundos)` (async, opcional) se llama al empezar
+    ("running") y al terminar ("done", "error" o "skipped") cada etapa.
+    """
+    async def stage(name, awaitable):
+        if on_stage:
+            await on_stage(name, "running", None)
+        start = time.perf_counter()
+        try:
+            result = await awaitable
+        except Exception:
+            if on_stage:
+                await on_stage(name, "error", time.perf_counter() - start)
+            raise
+        if on_stage:
+            await on_stage(name, "done", time.perf_counter() - start)
+        return result
+
+    # OCR (pool de procesos)
+    raw_text = await stage("ocr", run_blocking(ocr_executor, ocr_file, path, workers=OCR_PAGE_WORKERS))
+    
+    # Obtener historial de facturas del usuario para contexto
+    historial = await run_blocking(db_executor, get_user_invoice_history, user.id, limit=5)
+    
+    # PRIMERO: Intentar extracción con IA (modelo analiza directamente el texto OCR + historial)
+    data_from_ia: Optional[Dict[str, Any]] = None
+    try:
+        data_from_ia = await stage(
+            "ai_extract",
+            run_llm(
+                extraer_datos_con_ia_async,
+                raw_text,
+                historial_usuario=historial if historial else None,
+            ),
+        )
+        print(f"✓ Datos extraídos con IA local (usando {len(historial)} facturas anteriores como contexto)")
+    except Exception as e:
+        print(f"⚠️ Error extrayendo con IA local: {e}")
+        data_from_ia = None
+    
+    # FALLBACK: Extracción clásica (solo si la IA falló)
+    data_initial = await stage("extract", run_blocking(ocr_executor, extract_invoice_data, raw_text))
+    
+    # Usar datos de IA si están disponibles, sino usar los clásicos
+    data_refined: Optional[Dict[str, Any]] = data_from_ia if data_from_ia else None
+    
+    # Si refine=True y no tenemos datos de IA, intentar refinamiento adicional
+    if refine and not data_refined:
+        try:
+            data_refined = await stage("refine", run_llm(refinar_datos_factura_async, raw_text, data_initial))
+        except Exception as e:
+            print(f"⚠️ Error refinando con IA local: {e}")
+            data_refined = None
+    elif on_stage:
+        await on_stage("refine", "skipped", None)
+
+    # Guardar AUTOMÁTICAMENTE toda la información en BD (asociada al usuario)
+    datos_para_guardar = data_refined or data_initial
+    invoice_id = await stage("save", run_blocking(db_executor, save_invoice, user, datos_para_guardar, raw_text))
+
+    return ProcessInvoiceResponse(
+        raw_text=raw_text,
+        data_initial=data_initial,
+        data_refined=data_refined,
+        saved_to_db=invoice_id is not None,
+        invoice_id=invoice_id,
+    )
+
+
+def _upload_suffix(filename: Optional[str]) -> str:
+    """Extensión (con punto) del nombre de archivo subido, o cadena vacía"""
+    if filename and "." in filename:
+        return "." + filename.rsplit(".", 1)[1].lower()
+    return ""
+
+
+async def save_upload(file: UploadFile, directory: Optional[str] = None) -> str:
+    """
+    Copia la subida a un archivo temporal por bloques (memoria acotada sin
+    importar el tamaño) y devuelve su ruta. El tipo se detecta en el primer
+    bloque y fija la extensión, así el OCR no vuelve a abrir el archivo para
+    saber si es PDF. 413 si supera MAX_UPLOAD_BYTES, 415 si no es PDF ni imagen.
+    """
+    first = await file.read(UPLOAD_CHUNK_SIZE)
+    suffix = sniff_suffix(first)
+    if suffix is None:
+        suffix = _upload_suffix(file.filename)
+        if suffix not in SUPPORTED_UPLOAD_SUFFIXES:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail="Tipo de archivo no soportado (se acepta PDF o imagen)",
+            )
+
+    try:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(delete=False, dir=directory, suffix=suffix)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"No se pudo guardar archivo temporal: {e}")
+
+    size = 0
+    try:
+        with tmp:
+            chunk = first
+            while chunk:
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail=_too_large_detail(MAX_UPLOAD_BYTES))
+                tmp.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    except HTTPException:
+        os.remove(tmp.name)
+        raise
+    except Exception as e:
+        os.remove(tmp.name)
+        raise HTTPException(status_code=500, detail=f"No se pudo guardar archivo temporal: {e}")
+    return tmp.name
 
 
 @app.post("/api/process-invoice", response_model=ProcessInvoiceResponse)
@@ -291,88 +798,500 @@ async def process_invoice(
     Sube un archivo de factura, realiza OCR + extracción clásica,
     opcionalmente refinamiento con IA local y guardado en BD.
     """
+    tmp_path = await save_upload(file)
+
     try:
-        suffix = ""
-        if "." in file.filename:
-            suffix = "." + file.filename.rsplit(".", 1)[1].lower()
-    except Exception:
-        suffix = ""
+        return await run_invoice_pipeline(tmp_path, current_user, refine=refine)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except Exception:
+            pass
+
+
+# ---------------------------------------------------------------------------
+# Cola de trabajos: /api/jobs devuelve un id al instante y el pipeline corre en
+# segundo plano. Los trabajos se guardan en la BD, de modo que los pendientes
+# se reanudan tras un reinicio del servidor.
+# ---------------------------------------------------------------------------
+
+job_queue: Optional[asyncio.Queue] = None
+queued_job_ids: set = set()  # Ids en job_queue, para no encolar dos veces el mismo
+
+
+def enqueue_job(job_id: str) -> None:
+    if job_id not in queued_job_ids:
+        queued_job_ids.add(job_id)
+        job_queue.put_nowait(job_id)
+
+
+class JobSubmitResponse(BaseModel):
+    job_id: str
+    status: str
+
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    stage: Optional[str] = None
+    progress: Dict[str, Any] = {}
+    filename: Optional[str] = None
+    error: Optional[str] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
 
-    import tempfile, os
 
+def create_job(user_id: int, filename: Optional[str], file_path: str, refine: bool) -> str:
+    """Registra un trabajo nuevo en estado 'queued' y devuelve su id"""
+    db = SessionLocal()
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"No se pudo guardar archivo temporal: {e}")
+        job = InvoiceJob(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            status="queued",
+            progress="{}",
+            filename=filename,
+            file_path=file_path,
+            refine=refine,
+        )
+        db.add(job)
+        db.commit()
+        return job.id
+    finally:
+        db.close()
+
 
+def get_job(job_id: str, user_id: int) -> Optional[InvoiceJob]:
+    """Devuelve el trabajo si existe y pertenece al usuario"""
+    db = SessionLocal()
     try:
-        # OCR
-        raw_text = ocr_file(tmp_path)
-        
-        # Obtener historial de facturas del usuario para contexto
-        historial = get_user_invoice_history(current_user.id, limit=5)
-        
-        # PRIMERO: Intentar extracción con IA (modelo analiza directamente el texto OCR + historial)
-        data_from_ia: Optional[Dict[str, Any]] = None
+        return db.query(InvoiceJob).filter(
+            InvoiceJob.id == job_id, InvoiceJob.user_id == user_id
+        ).first()
+    finally:
+        db.close()
+
+
+def _lease_until() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)
+
+
+def claim_job(job_id: str) -> Optional[InvoiceJob]:
+    """
+    Pasa un trabajo de 'queued' a 'running' de forma atómica, a nombre de este
+    proceso (WORKER_ID) y con una concesión de JOB_LEASE_SECONDS. Devuelve el
+    trabajo si lo hemos reclamado nosotros, None si otro proceso lo tomó antes.
+    """
+    db = SessionLocal()
+    try:
+        claimed = db.query(InvoiceJob).filter(
+            InvoiceJob.id == job_id, InvoiceJob.status == "queued"
+        ).update({
+            "status": "running",
+            "worker_id": WORKER_ID,
+            "lease_until": _lease_until(),
+            "attempts": InvoiceJob.attempts + 1,
+            "updated_at": datetime.utcnow(),
+        })
+        db.commit()
+        if not claimed:
+            return None
+        return db.query(InvoiceJob).filter(InvoiceJob.id == job_id).first()
+    finally:
+        db.close()
+
+
+def renew_job_lease(job_id: str) -> bool:
+    """Prolonga la concesión de un trabajo nuestro; False si ya no es nuestro"""
+    db = SessionLocal()
+    try:
+        renewed = db.query(InvoiceJob).filter(
+            InvoiceJob.id == job_id,
+            InvoiceJob.status == "running",
+            InvoiceJob.worker_id == WORKER_ID,
+        ).update({"lease_until": _lease_until()})
+        db.commit()
+        return bool(renewed)
+    finally:
+        db.close()
+
+
+def release_job(job_id: str) -> bool:
+    """
+    Devuelve a 'queued' un trabajo nuestro interrumpido por un apagado ordenado,
+    sin contarlo como intento fallido, para que lo retome el siguiente arranque
+    """
+    db = SessionLocal()
+    try:
+        released = db.query(InvoiceJob).filter(
+            InvoiceJob.id == job_id,
+            InvoiceJob.status == "running",
+            InvoiceJob.worker_id == WORKER_ID,
+        ).update({
+            "status": "queued",
+            "stage": None,
+            "worker_id": None,
+            "lease_until": None,
+            "attempts": InvoiceJob.attempts - 1,
+            "updated_at": datetime.utcnow(),
+        })
+        db.commit()
+        return bool(released)
+    finally:
+        db.close()
+
+
+def update_job(job_id: str, **fields) -> None:
+    """Actualiza campos de un trabajo"""
+    db = SessionLocal()
+    try:
+        fields["updated_at"] = datetime.utcnow()
+        db.query(InvoiceJob).filter(InvoiceJob.id == job_id).update(fields)
+        db.commit()
+    finally:
+        db.close()
+
+
+def requeue_pending_jobs() -> List[str]:
+    """
+    Devuelve a 'queued' los trabajos en 'running' cuya concesión venció (su
+    proceso murió o se reinició) y lista los ids pendientes, del más antiguo al
+    más reciente. Los que ya agotaron JOB_MAX_ATTEMPTS pasan a 'error'. Los
+    trabajos que otro proceso sigue ejecutando (concesión vigente) no se tocan.
+    """
+    db = SessionLocal()
+    try:
+        expired = db.query(InvoiceJob).filter(
+            InvoiceJob.status == "running",
+            or_(InvoiceJob.lease_until.is_(None), InvoiceJob.lease_until < datetime.utcnow()),
+        )
+        expired.filter(InvoiceJob.attempts >= JOB_MAX_ATTEMPTS).update({
+            "status": "error",
+            "error": f"El trabajo se interrumpió {JOB_MAX_ATTEMPTS} veces sin terminar",
+            "worker_id": None,
+            "updated_at": datetime.utcnow(),
+        }, synchronize_session=False)
+        expired.filter(InvoiceJob.attempts < JOB_MAX_ATTEMPTS).update({
+            "status": "queued",
+            "worker_id": None,
+            "lease_until": None,
+            "updated_at": datetime.utcnow(),
+        }, synchronize_session=False)
+        db.commit()
+        return [
+            job_id for (job_id,) in db.query(InvoiceJob.id)
+            .filter(InvoiceJob.status == "queued")
+            .order_by(InvoiceJob.created_at)
+        ]
+    finally:
+        db.close()
+
+
+def prune_finished_jobs() -> int:
+    """Borra los trabajos terminados hace más de JOB_RETENTION_HOURS (y su archivo, si quedó)"""
+    cutoff = datetime.utcnow() - timedelta(hours=JOB_RETENTION_HOURS)
+    db = SessionLocal()
+    try:
+        old = db.query(InvoiceJob).filter(
+            InvoiceJob.status.in_(("done", "error")), InvoiceJob.updated_at < cutoff
+        )
+        for (file_path,) in old.with_entities(InvoiceJob.file_path):
+            _remove_file(file_path)
+        deleted = old.delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+
+def _remove_file(path: Optional[str]) -> None:
+    if path:
         try:
-            data_from_ia = extraer_datos_con_ia(raw_text, historial_usuario=historial if historial else None)
-            print(f"✓ Datos extraídos con IA local (usando {len(historial)} facturas anteriores como contexto)")
-        except Exception as e:
-            print(f"⚠️ Error extrayendo con IA local: {e}")
-            data_from_ia = None
-        
-        # FALLBACK: Extracción clásica (solo si la IA falló)
-        data_initial = extract_invoice_data(raw_text)
-        
-        # Usar datos de IA si están disponibles, sino usar los clásicos
-        data_refined: Optional[Dict[str, Any]] = data_from_ia if data_from_ia else None
-        
-        # Si refine=True y no tenemos datos de IA, intentar refinamiento adicional
-        if refine and not data_refined:
-            try:
-                data_refined = refinar_datos_factura(raw_text, data_initial)
-            except Exception as e:
-                print(f"⚠️ Error refinando con IA local: {e}")
-                data_refined = None
-
-        # Guardar AUTOMÁTICAMENTE toda la información en BD (asociada al usuario)
-        datos_para_guardar = data_refined or data_initial
-        saved = False
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def job_result_json(result: ProcessInvoiceResponse) -> str:
+    """
+    JSON que se guarda en invoice_jobs.result, sin el texto OCR: se quita de
+    data_initial/data_refined (se anota dónde estaba) y, si la factura se guardó,
+    también de la respuesta, porque ya está comprimido en su InvoiceBlob.
+    """
+    data = result.model_dump()
+    data["raw_text_in"] = []
+    for key in ("data_initial", "data_refined"):
+        if isinstance(data[key], dict) and "raw_text" in data[key]:
+            data[key] = {k: v for k, v in data[key].items() if k != "raw_text"}
+            data["raw_text_in"].append(key)
+    if data["invoice_id"] is not None:
+        del data["raw_text"]
+    return json.dumps(data, ensure_ascii=False)
+
+
+def load_job_result(job: InvoiceJob) -> ProcessInvoiceResponse:
+    """Inverso de job_result_json: repone el texto OCR desde la factura guardada"""
+    data = json.loads(job.result)
+    raw_text_in = data.pop("raw_text_in", [])
+    if "raw_text" not in data:
+        db = SessionLocal()
         try:
-            db = SessionLocal()
-            invoice = Invoice(
-                user_id=current_user.id,
-                invoice_number=str(datos_para_guardar.get("invoice_number") or ""),
-                supplier=str(datos_para_guardar.get("supplier") or ""),
-                nit=str(datos_para_guardar.get("nit") or ""),
-                date=str(datos_para_guardar.get("date") or ""),
-                subtotal=str(datos_para_guardar.get("subtotal") or ""),
-                tax=str(datos_para_guardar.get("tax") or ""),
-                total=str(datos_para_guardar.get("total") or ""),
-                data_complete=json.dumps(datos_para_guardar, ensure_ascii=False),
-                raw_text_ocr=raw_text,
-            )
-            db.add(invoice)
-            db.commit()
-            saved = True
+            blob = db.query(InvoiceBlob).join(Invoice).filter(
+                Invoice.id == data["invoice_id"], Invoice.user_id == job.user_id
+            ).first()
+            data["raw_text"] = (blob.raw_text_ocr if blob is not None else None) or ""
+        finally:
             db.close()
-            print(f"✓ Factura guardada en BD para usuario {current_user.username}")
-        except Exception as e:
-            print(f"⚠️ Error guardando en BD: {e}")
+    for key in raw_text_in:
+        data[key]["raw_text"] = data["raw_text"]
+    return ProcessInvoiceResponse(**data)
 
-        return ProcessInvoiceResponse(
-            raw_text=raw_text,
-            data_initial=data_initial,
-            data_refined=data_refined,
-            saved_to_db=saved,
+
+def get_user_by_id(user_id: int) -> Optional[User]:
+    """Busca un usuario por id (bloqueante: usar desde db_executor)"""
+    db = SessionLocal()
+    try:
+        return db.query(User).filter(User.id == user_id).first()
+    finally:
+        db.close()
+
+
+async def run_job(job_id: str) -> None:
+    """Ejecuta el pipeline de un trabajo registrando el progreso de cada etapa"""
+    job = await run_blocking(db_executor, claim_job, job_id)
+    if job is None:
+        return
+
+    progress: Dict[str, Any] = {}
+
+    async def heartbeat():
+        # Renovar la concesión mientras el pipeline sigue en marcha
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            if not await run_blocking(db_executor, renew_job_lease, job_id):
+                print(f"⚠️ Trabajo {job_id}: se perdió la concesión (otro proceso lo reencoló)")
+                return
+
+    lease = asyncio.create_task(heartbeat())
+
+    async def on_stage(name, status, seconds):
+        progress[name] = {"status": status}
+        if seconds is not None:
+            progress[name]["seconds"] = round(seconds, 3)
+        await run_blocking(db_executor, update_job, job_id, stage=name, progress=json.dumps(progress))
+
+    try:
+        user = await run_blocking(db_executor, get_user_by_id, job.user_id)
+        if user is None:
+            raise Exception("El usuario del trabajo ya no existe")
+        result = await run_invoice_pipeline(job.file_path, user, refine=job.refine, on_stage=on_stage)
+        await run_blocking(
+            db_executor, update_job, job_id,
+            status="done", stage=None, worker_id=None, lease_until=None, result=job_result_json(result),
+        )
+    except asyncio.CancelledError:
+        # Apagado del servidor: el trabajo vuelve a la cola con su archivo intacto
+        await run_blocking(db_executor, release_job, job_id)
+        raise
+    except Exception as e:
+        print(f"⚠️ Error en trabajo {job_id}: {e}")
+        await run_blocking(
+            db_executor, update_job, job_id, status="error", worker_id=None, lease_until=None, error=str(e)
         )
     finally:
+        lease.cancel()
+    # El archivo subido solo se borra cuando el trabajo queda terminado
+    _remove_file(job.file_path)
+
+
+async def job_worker() -> None:
+    """Trabajador de la cola: procesa los trabajos de uno en uno"""
+    while True:
+        job_id = await job_queue.get()
+        queued_job_ids.discard(job_id)
         try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
+            await run_job(job_id)
+        except Exception as e:
+            print(f"⚠️ Error inesperado en trabajo {job_id}: {e}")
+        finally:
+            job_queue.task_done()
+
+
+async def job_reaper() -> None:
+    """
+    Al arrancar y luego cada JOB_LEASE_SECONDS: reencola los trabajos cuyo
+    proceso dejó de renovar la concesión (caído o reciclado) y los pendientes,
+    y borra los terminados hace más de JOB_RETENTION_HOURS.
+    """
+    while True:
+        try:
+            for job_id in await run_blocking(db_executor, requeue_pending_jobs):
+                enqueue_job(job_id)
+        except Exception as e:
+            print(f"⚠️ Error al reencolar trabajos: {e}")
+        try:
+            await run_blocking(db_executor, prune_finished_jobs)
+        except Exception as e:
+            print(f"⚠️ Error al borrar trabajos antiguos: {e}")
+        await asyncio.sleep(JOB_LEASE_SECONDS)
+
+
+def _job_status(job: InvoiceJob) -> JobStatusResponse:
+    try:
+        progress = json.loads(job.progress) if job.progress else {}
+    except json.JSONDecodeError:
+        progress = {}
+    return JobStatusResponse(
+        job_id=job.id,
+        status=job.status,
+        stage=job.stage,
+        progress=progress,
+        filename=job.filename,
+        error=job.error,
+        created_at=job.created_at.isoformat() if job.created_at else None,
+        updated_at=job.updated_at.isoformat() if job.updated_at else None,
+    )
+
+
+@app.post("/api/jobs", response_model=JobSubmitResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(
+    file: UploadFile = File(...),
+    refine: bool = True,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Encola el procesamiento de una factura y devuelve el id del trabajo sin
+    esperar al resultado. Consultar /api/jobs/{job_id} para ver el progreso.
+    """
+    file_path = await save_upload(file, directory=JOBS_DIR)
+    job_id = await run_blocking(db_executor, create_job, current_user.id, file.filename, file_path, refine)
+    enqueue_job(job_id)
+    return JobSubmitResponse(job_id=job_id, status="queued")
+
+
+@app.get("/api/jobs/{job_id}", response_model=JobStatusResponse)
+async def job_status(job_id: str, current_user: User = Depends(get_current_user)):
+    """Estado y progreso por etapa de un trabajo"""
+    job = await run_blocking(db_executor, get_job, job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return _job_status(job)
+
+
+@app.get("/api/jobs/{job_id}/result", response_model=ProcessInvoiceResponse)
+async def job_result(job_id: str, current_user: User = Depends(get_current_user)):
+    """Resultado de un trabajo terminado (409 si aún no ha terminado)"""
+    job = await run_blocking(db_executor, get_job, job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if job.status == "error":
+        raise HTTPException(status_code=500, detail=f"El trabajo falló: {job.error}")
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"El trabajo aún no ha terminado (estado: {job.status})")
+    return await run_blocking(db_executor, load_job_result, job)
+
+
+def get_spend_report(user_id: int, start: Optional[date], end: Optional[date]) -> List[Dict[str, Any]]:
+    """Gasto por proveedor y mes (bloqueante: usar desde db_executor)"""
+    db = SessionLocal()
+    try:
+        return spend_by_supplier_month(db, user_id, start=start, end=end)
+    finally:
+        db.close()
+
+
+@app.get("/api/reports/spend")
+async def spend_report(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Gasto total por proveedor, mes y moneda del usuario (opcionalmente entre
+    `start` y `end`, formato AAAA-MM-DD). Se agrega en SQL sobre las columnas tipadas.
+    """
+    rows = await run_blocking(db_executor, get_spend_report, current_user.id, start, end)
+    return {"rows": rows}
+
+
+def get_invoice_page(user_id: int, limit: int, cursor: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Página del listado de facturas (bloqueante: usar desde db_executor)"""
+    db = SessionLocal()
+    try:
+        return list_invoices(db, user_id, limit=limit, cursor=cursor)
+    finally:
+        db.close()
+
+
+def get_invoice_count(user_id: int) -> int:
+    """Número de facturas del usuario (bloqueante: usar desde db_executor)"""
+    db = SessionLocal()
+    try:
+        return count_invoices(db, user_id)
+    finally:
+        db.close()
+
+
+@app.get("/api/invoices")
+async def list_invoices_endpoint(
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Facturas del usuario, más recientes primero, con solo los campos de resumen.
+    Para la página siguiente se pasa el `next_cursor` de la respuesta como `cursor`
+    (null en la última página). El total está en /api/invoices/count.
+    """
+    limit = max(1, min(limit, LIST_MAX_LIMIT))
+    try:
+        items, next_cursor = await run_blocking(db_executor, get_invoice_page, current_user.id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": items, "next_cursor": next_cursor}
+
+
+@app.get("/api/invoices/count")
+async def count_invoices_endpoint(current_user: User = Depends(get_current_user)):
+    """Número total de facturas del usuario"""
+    return {"total": await run_blocking(db_executor, get_invoice_count, current_user.id)}
+
+
+def get_search_results(user_id: int, query: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Búsqueda de texto completo en las facturas del usuario; None si la BD no
+    tiene índice de búsqueda (bloqueante: usar desde db_executor)
+    """
+    db = SessionLocal()
+    try:
+        return search_invoices(db, user_id, query, limit=limit)
+    finally:
+        db.close()
+
+
+@app.get("/api/invoices/search")
+async def search_invoices_endpoint(
+    q: str,
+    limit: int = 20,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Busca `q` en el texto OCR, número, proveedor y NIT de las facturas del usuario.
+    Devuelve las más relevantes (bm25) con un fragmento donde aparecen los términos.
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="La consulta no puede estar vacía")
+    limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+
+    start = time.perf_counter()
+    results = await run_blocking(db_executor, get_search_results, current_user.id, q, limit)
+    if results is None:
+        raise HTTPException(status_code=503, detail="La búsqueda de texto completo no está disponible (SQLite sin FTS5)")
+    return {
+        "query": q,
+        "results": results,
+        "took_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
 
 
 @app.get("/api/health")
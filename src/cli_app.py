@@ -1,46 +1,200 @@
 import argparse
-from ocr_utils import ocr_file
-from extractor import extract_invoice_data
-from db import SessionLocal, Invoice, init_db
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ocr_utils import ocr_file, ocr_pages
+from extractor import extract_invoice_data, get_nlp
+from db import SessionLocal, Invoice, User, init_db, normalize_invoice_fields
+import glob
 import json
+import os
 import sys
+import time
 
-def save_to_db(data):
-    """Guarda los datos extraídos en la base de datos"""
+# Extensiones que se recogen al recorrer carpetas en modo lote
+SUPPORTED_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+def get_user_id(username):
+    """Id del usuario `username` (dueño de las facturas guardadas), o None si no existe"""
+    db = SessionLocal()
     try:
-        db = SessionLocal()
+        user = db.query(User).filter(User.username == username).first()
+        return user.id if user else None
+    finally:
+        db.close()
+
+def save_to_db(data, user_id, db=None):
+    """
+    Guarda los datos extraídos en la base de datos a nombre de `user_id` (en la
+    sesión `db` si se pasa)
+    """
+    own_session = db is None
+    try:
+        if own_session:
+            db = SessionLocal()
         invoice = Invoice(
+            user_id=user_id,
             invoice_number=data.get('invoice_number'),
             supplier=data.get('supplier'),
             nit=data.get('nit'),
             date=data.get('date'),
             subtotal=data.get('subtotal'),
             tax=data.get('tax'),
-            total=data.get('total')
+            total=data.get('total'),
+            **normalize_invoice_fields(data)
         )
         db.add(invoice)
         db.commit()
         invoice_id = invoice.id
-        db.close()
+        if own_session:
+            db.close()
         return invoice_id
     except Exception as e:
+        if not own_session:
+            db.rollback()
         print(f"Error al guardar en BD: {e}", file=sys.stderr)
         return None
 
+def _is_glob(path):
+    return any(char in path for char in '*?[')
+
+def expand_inputs(inputs):
+    """
+    Convierte la lista de entradas (archivos, carpetas o patrones glob) en una
+    lista ordenada y sin duplicados de archivos a procesar
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                files.extend(
+                    os.path.join(root, name) for name in names
+                    if os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS
+                )
+        elif _is_glob(item):
+            files.extend(p for p in glob.glob(item, recursive=True) if os.path.isfile(p))
+        else:
+            files.append(item)
+
+    seen = set()
+    unique = []
+    for path in sorted(files):
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            unique.append(path)
+    return unique
+
+def load_checkpoint(jsonl_path):
+    """Archivos ya procesados con éxito según un JSONL de una ejecución anterior"""
+    done = set()
+    if not jsonl_path or not os.path.exists(jsonl_path):
+        return done
+    with open(jsonl_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # línea truncada por una interrupción
+            if record.get('file') and 'error' not in record:
+                done.add(os.path.abspath(record['file']))
+    return done
+
+def _init_batch_worker():
+    """Inicializa cada proceso del pool: carga spaCy una sola vez por proceso"""
+    get_nlp()
+
+def process_file(path):
+    """OCR + extracción de un archivo en un proceso del pool (modo lote)"""
+    start = time.perf_counter()
+    try:
+        # El paralelismo ya está en el pool de archivos: OCR secuencial por archivo
+        pages = ocr_pages(path, workers=1)
+        text = "\n\n".join(p["text"] for p in pages)
+        data = extract_invoice_data(text)
+        return {"file": path, "pages": len(pages), "data": data,
+                "seconds": round(time.perf_counter() - start, 3)}
+    except Exception as e:
+        return {"file": path, "error": str(e),
+                "seconds": round(time.perf_counter() - start, 3)}
+
+def run_batch(args):
+    """
+    Modo lote: reparte los archivos en un pool de procesos y escribe un
+    registro JSON por línea. Los archivos ya presentes (sin error) en el JSONL
+    de salida se saltan, de modo que una ejecución interrumpida se reanuda.
+    """
+    files = expand_inputs(args.inputs)
+    done = load_checkpoint(args.jsonl)
+    pending = [f for f in files if os.path.abspath(f) not in done]
+    print(f"📂 {len(files)} archivos encontrados, {len(files) - len(pending)} ya procesados, "
+          f"{len(pending)} pendientes", file=sys.stderr)
+
+    out = open(args.jsonl, 'a', encoding='utf-8') if args.jsonl else sys.stdout
+    db = SessionLocal() if args.save_db else None
+    processed = failed = pages = 0
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_batch_worker) as pool:
+            futures = [pool.submit(process_file, path) for path in pending]
+            for future in as_completed(futures):
+                record = future.result()
+                if 'error' in record:
+                    failed += 1
+                    print(f"❌ {record['file']}: {record['error']}", file=sys.stderr)
+                else:
+                    processed += 1
+                    pages += record['pages']
+                    if db is not None:
+                        record['db_id'] = save_to_db(record['data'], args.user_id, db)
+                    if args.verbose:
+                        print(f"✓ {record['file']} ({record['pages']} págs, {record['seconds']}s)",
+                              file=sys.stderr)
+                # Escribir y volcar cada registro: es el punto de control para reanudar
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if db is not None:
+            db.close()
+
+    elapsed = time.perf_counter() - start
+    rate = lambda n: n / elapsed if elapsed > 0 else 0.0
+    print(f"✅ {processed} archivos procesados, {failed} con error en {elapsed:.1f}s "
+          f"({rate(processed):.2f} archivos/s, {rate(pages):.2f} páginas/s)", file=sys.stderr)
+    return failed == 0
+
 def main():
     parser = argparse.ArgumentParser(
         description="Intelli-Invoice Extractor CLI - Extrae datos de facturas"
     )
-    parser.add_argument('file', help="Ruta al archivo PDF o imagen de la factura")
+    parser.add_argument('inputs', nargs='+', metavar='file',
+                        help="Ruta al archivo PDF o imagen de la factura; varias rutas, "
+                             "carpetas o patrones glob activan el modo lote")
     parser.add_argument('--save-db', action='store_true', help="Guardar en base de datos")
+    parser.add_argument('--user', help="Con --save-db: usuario (registrado) al que se asignan las facturas")
     parser.add_argument('--output', '-o', help="Guardar resultado en archivo JSON")
+    parser.add_argument('--jsonl', help="Modo lote: archivo JSON Lines de salida; si ya existe, "
+                                        "se saltan los archivos procesados (reanudación)")
+    parser.add_argument('--workers', '-j', type=int, default=os.cpu_count() or 1,
+                        help="Modo lote: número de procesos en paralelo")
     parser.add_argument('--verbose', '-v', action='store_true', help="Modo detallado")
     
     args = parser.parse_args()
     
     # Inicializar BD si se va a usar
     if args.save_db:
+        if not args.user:
+            parser.error("--save-db requiere --user (las facturas se guardan a nombre de un usuario)")
         init_db()
+        args.user_id = get_user_id(args.user)
+        if args.user_id is None:
+            parser.error(f"El usuario '{args.user}' no existe en la base de datos")
+    
+    batch = (args.jsonl or len(args.inputs) > 1 or os.path.isdir(args.inputs[0])
+             or _is_glob(args.inputs[0]))
+    if batch:
+        sys.exit(0 if run_batch(args) else 1)
+    args.file = args.inputs[0]
     
     # Paso 1: OCR
     if args.verbose:
@@ -70,7 +224,7 @@ def main():
     
     # Guardar en BD si se solicitó
     if args.save_db:
-        invoice_id = save_to_db(data)
+        invoice_id = save_to_db(data, args.user_id)
         if invoice_id:
             data['saved_to_db'] = True
             data['db_id'] = invoice_id
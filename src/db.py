@@ -1,15 +1,88 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, Text, DateTime
+from sqlalchemy import (
+    create_engine, Column, Integer, String, Float, Date, ForeignKey, Text, DateTime, Boolean,
+    Numeric, Index, LargeBinary, bindparam, event, extract, func, inspect, text, tuple_,
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
 import os
+import base64
 import json
+import re
+import unicodedata
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional: sin él se usa zlib
+    zstandard = None
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///data/invoices.db")
-engine = create_engine(DATABASE_URL, echo=False)
+
+# Perfil de SQLite para varios hilos/workers escribiendo a la vez:
+# WAL (lectores no bloquean al escritor), synchronous=NORMAL (fsync solo en
+# los checkpoints), caché de páginas y lecturas por mmap, y espera en lugar de
+# "database is locked" inmediato. SQLITE_TUNING=0 deja los valores por defecto.
+SQLITE_TUNING = os.getenv("SQLITE_TUNING", "1") != "0"
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE_MB = int(os.getenv("SQLITE_CACHE_SIZE_MB", "16"))  # por conexión
+SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "10000"))
+# Pool de conexiones compartido por los hilos del servidor (ver DB_CONCURRENCY)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+
+def _is_sqlite_file(url):
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def _engine_options(url):
+    """Argumentos de create_engine según el tipo de BD"""
+    if not SQLITE_TUNING or not _is_sqlite_file(url):
+        return {}  # Otros motores o SQLite en memoria: valores por defecto
+    return {
+        # Las conexiones del pool se usan desde distintos hilos (threadpool de FastAPI)
+        "connect_args": {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_pre_ping": False,  # Archivo local: una conexión no "caduca"
+    }
+
+
+engine = create_engine(DATABASE_URL, echo=False, **_engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(bind=engine)
 Base = declarative_base()
 
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Aplica el perfil de SQLite a cada conexión nueva del pool"""
+    if engine.dialect.name != "sqlite" or not SQLITE_TUNING:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        if _is_sqlite_file(engine.url):
+            cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_MB * 1024}")  # negativo = KiB
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+# Compresión de los textos grandes de cada factura (tabla invoice_blobs):
+# "zstd" si está instalado `zstandard`, si no "zlib"
+BLOB_CODEC = os.getenv("BLOB_CODEC", "zstd" if zstandard is not None else "zlib")
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
 class Invoice(Base):
     __tablename__ = "invoices"
     id = Column(Integer, primary_key=True, index=True)
@@ -22,13 +95,90 @@ class Invoice(Base):
     subtotal = Column(String)
     tax = Column(String)
     total = Column(String)
-    # Almacenar TODA la información extraída por el modelo como JSON
-    data_complete = Column(Text)  # JSON completo con todos los campos
-    raw_text_ocr = Column(Text)  # Texto OCR completo
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    # Valores normalizados (ver normalize_invoice_fields) para consultas en SQL
+    invoice_date = Column(Date)
+    subtotal_amount = Column(Numeric(14, 2))
+    tax_amount = Column(Numeric(14, 2))
+    total_amount = Column(Numeric(14, 2))
+    currency = Column(String(3))
     
     # Relación con usuario
     user = relationship("User", backref="invoices")
+    # Textos grandes en tabla aparte, comprimidos y cargados solo al acceder
+    blob = relationship(
+        "InvoiceBlob", uselist=False, lazy="select", cascade="all, delete-orphan", back_populates="invoice"
+    )
+
+    __table_args__ = (
+        Index("idx_invoices_user_date", "user_id", "invoice_date"),
+        Index("idx_invoices_user_supplier", "user_id", "supplier"),
+        Index("idx_invoices_user_created", "user_id", "created_at", "id"),  # listado paginado
+    )
+
+    def _get_blob(self):
+        if self.blob is None:
+            self.blob = InvoiceBlob()
+        return self.blob
+
+    # Almacenar TODA la información extraída por el modelo como JSON
+    @property
+    def data_complete(self):
+        """JSON completo con todos los campos (sin raw_text, que está en raw_text_ocr)"""
+        return self.blob.data_complete if self.blob is not None else None
+
+    @data_complete.setter
+    def data_complete(self, value):
+        self._get_blob().data_complete = value
+
+    @property
+    def raw_text_ocr(self):
+        """Texto OCR completo"""
+        return self.blob.raw_text_ocr if self.blob is not None else None
+
+    @raw_text_ocr.setter
+    def raw_text_ocr(self, value):
+        self._get_blob().raw_text_ocr = value
+
+
+class InvoiceBlob(Base):
+    """
+    Texto OCR y JSON completo de una factura, comprimidos (zlib o zstd). Separados
+    de `invoices` para que los listados y consultas no lean estos datos.
+    """
+    __tablename__ = "invoice_blobs"
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), primary_key=True)
+    codec = Column(String(8), nullable=False, default=BLOB_CODEC)
+    data_complete_z = Column(LargeBinary)
+    raw_text_ocr_z = Column(LargeBinary)
+
+    invoice = relationship("Invoice", back_populates="blob")
+
+    @property
+    def data_complete(self):
+        return decompress_text(self.codec, self.data_complete_z)
+
+    @data_complete.setter
+    def data_complete(self, value):
+        self._set("data_complete_z", value)
+
+    @property
+    def raw_text_ocr(self):
+        return decompress_text(self.codec, self.raw_text_ocr_z)
+
+    @raw_text_ocr.setter
+    def raw_text_ocr(self, value):
+        self._set("raw_text_ocr_z", value)
+
+    def _set(self, column, value):
+        # Ambos textos comparten codec: si cambia, recomprimir el otro
+        codec = self.codec or BLOB_CODEC
+        if codec != BLOB_CODEC:
+            for other in ("data_complete_z", "raw_text_ocr_z"):
+                if other != column and getattr(self, other) is not None:
+                    setattr(self, other, compress_text(BLOB_CODEC, decompress_text(codec, getattr(self, other))))
+        self.codec = BLOB_CODEC
+        setattr(self, column, compress_text(BLOB_CODEC, value))
 
 
 class User(Base):
@@ -38,5 +188,619 @@ class User(Base):
     password_hash = Column(String, nullable=False)
 
 
+class InvoiceJob(Base):
+    """Trabajo asíncrono de procesamiento de una factura (cola local sin broker)"""
+    __tablename__ = "invoice_jobs"
+    id = Column(String, primary_key=True)  # uuid4 en hexadecimal
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    status = Column(String, nullable=False, default="queued", index=True)  # queued | running | done | error
+    stage = Column(String)  # Etapa en curso del pipeline
+    progress = Column(Text)  # JSON {etapa: {"status": ..., "seconds": ...}}
+    filename = Column(String)
+    file_path = Column(String)  # Copia del archivo subido hasta que termina el trabajo
+    refine = Column(Boolean, default=True)
+    result = Column(Text)  # JSON con la respuesta del pipeline
+    error = Column(Text)
+    # Concesión del proceso que lo ejecuta: solo se reencola si lease_until venció
+    worker_id = Column(String)
+    lease_until = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)  # Veces que se ha reclamado
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    ensure_search_index()
+
+
+def compress_text(codec, text):
+    """Comprime un texto con `codec` ("zlib" o "zstd"); None se mantiene"""
+    if text is None:
+        return None
+    data = text.encode("utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("BLOB_CODEC=zstd requiere el paquete 'zstandard'")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress_text(codec, blob):
+    """Inverso de compress_text"""
+    if blob is None:
+        return None
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Hay textos comprimidos con zstd: instala el paquete 'zstandard'")
+        data = zstandard.ZstdDecompressor().decompress(blob)
+    else:
+        data = zlib.decompress(blob)
+    return data.decode("utf-8")
+
+
+def strip_raw_text(data_complete):
+    """
+    JSON de data_complete sin la clave raw_text (duplicaba raw_text_ocr).
+    Acepta un dict o un JSON en texto y devuelve texto.
+    """
+    if data_complete is None:
+        return None
+    if isinstance(data_complete, str):
+        try:
+            data = json.loads(data_complete)
+        except json.JSONDecodeError:
+            return data_complete
+    else:
+        data = data_complete
+    if isinstance(data, dict):
+        data = {k: v for k, v in data.items() if k != "raw_text"}
+    return json.dumps(data, ensure_ascii=False)
+
+
+# ---------------------------------------------------------------------------
+# Normalización de los campos extraídos (texto libre del OCR o del modelo) a
+# valores tipados, para guardar en invoice_date / *_amount / currency.
+# ---------------------------------------------------------------------------
+
+MONTH_NUMBERS = {
+    'enero': 1, 'febrero': 2, 'marzo': 3, 'abril': 4, 'mayo': 5, 'junio': 6, 'julio': 7,
+    'agosto': 8, 'septiembre': 9, 'setiembre': 9, 'octubre': 10, 'noviembre': 11, 'diciembre': 12,
+    'ene': 1, 'feb': 2, 'mar': 3, 'abr': 4, 'may': 5, 'jun': 6, 'jul': 7, 'ago': 8,
+    'sep': 9, 'sept': 9, 'set': 9, 'oct': 10, 'nov': 11, 'dic': 12,
+    'january': 1, 'february': 2, 'march': 3, 'april': 4, 'june': 6, 'july': 7,
+    'august': 8, 'september': 9, 'october': 10, 'november': 11, 'december': 12,
+    'jan': 1, 'apr': 4, 'aug': 8, 'dec': 12,
+}
+
+CURRENCY_ALIASES = {
+    'COP': 'COP', 'PESOS': 'COP', 'PESO': 'COP', '$': 'COP', 'COL$': 'COP',
+    'USD': 'USD', 'US$': 'USD', 'DOLARES': 'USD', 'DÓLARES': 'USD', 'DOLLARS': 'USD',
+    'EUR': 'EUR', '€': 'EUR', 'EUROS': 'EUR',
+    'MXN': 'MXN', 'PEN': 'PEN', 'S/': 'PEN', 'CLP': 'CLP', 'ARS': 'ARS',
+}
+
+_NUMERIC_DATE = re.compile(r'^(\d{1,4})[-/.](\d{1,2})(?:[-/.](\d{1,4}))?$')
+_TEXT_DATE = re.compile(r'(?:(\d{1,2})\s*(?:de\s+)?)?([a-záéíóú]+)\.?\s*(?:de\s+|del\s+|[-/,]\s*)?(\d{4})')
+
+
+def parse_amount(value):
+    """
+    Convierte un monto ('$ 1.234.567,89', '178,500', 'COP 1,234.50', 1234.5)
+    a Decimal con dos decimales, o None si no es un número.
+
+    Con un solo tipo de separador se asume separador de miles si aparece varias
+    veces o va seguido de exactamente tres dígitos (convención colombiana).
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        try:
+            return Decimal(str(value)).quantize(Decimal('0.01'))
+        except InvalidOperation:
+            return None
+
+    text = re.sub(r'[^\d.,\-]', '', str(value))
+    negative = text.startswith('-')
+    text = text.replace('-', '')
+    if not re.search(r'\d', text):
+        return None
+
+    if '.' in text and ',' in text:
+        decimal_sep = '.' if text.rfind('.') > text.rfind(',') else ','
+        thousands_sep = ',' if decimal_sep == '.' else '.'
+        text = text.replace(thousands_sep, '').replace(decimal_sep, '.')
+    elif '.' in text or ',' in text:
+        sep = '.' if '.' in text else ','
+        head, _, tail = text.rpartition(sep)
+        if text.count(sep) > 1 or len(tail) == 3:
+            text = text.replace(sep, '')
+        else:
+            text = head.replace(sep, '') + '.' + tail
+
+    try:
+        amount = Decimal(text).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        return None
+    return -amount if negative else amount
+
+
+def parse_invoice_date(value):
+    """
+    Convierte una fecha de factura a `date`: ISO ('2025-09-15', '2025-09'),
+    día/mes/año ('15/09/2025', '15-09-25') o texto ('15 de septiembre de 2025',
+    'SEPTIEMBRE - 2025'). Sin día se usa el primero del mes. None si no se reconoce.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+
+    text = str(value).strip().lower()
+    if not text:
+        return None
+
+    match = _NUMERIC_DATE.match(text.split('t')[0].split(' ')[0])
+    if match:
+        a, b, c = match.groups()
+        if len(a) == 4:  # AAAA-MM[-DD]
+            year, month, day = int(a), int(b), int(c) if c else 1
+        elif c:  # DD/MM/AA[AA]
+            day, month, year = int(a), int(b), int(c)
+            if year < 100:
+                year += 2000
+        else:
+            return None
+        try:
+            return date(year, month, day)
+        except ValueError:
+            return None
+
+    for day, month_name, year in _TEXT_DATE.findall(text):
+        month = MONTH_NUMBERS.get(month_name)
+        if month:
+            try:
+                return date(int(year), month, int(day) if day else 1)
+            except ValueError:
+                return None
+    return None
+
+
+def normalize_currency(value):
+    """Código ISO de la moneda ('COP', 'USD', ...) o None si no se reconoce"""
+    if not value:
+        return None
+    text = str(value).strip().upper()
+    if text in CURRENCY_ALIASES:
+        return CURRENCY_ALIASES[text]
+    if re.fullmatch(r'[A-Z]{3}', text):
+        return text
+    return None
+
+
+def normalize_invoice_fields(data):
+    """Columnas tipadas de Invoice a partir de los datos extraídos de una factura"""
+    return {
+        "invoice_date": parse_invoice_date(data.get("date")),
+        "subtotal_amount": parse_amount(data.get("subtotal")),
+        "tax_amount": parse_amount(data.get("tax")),
+        "total_amount": parse_amount(data.get("total")),
+        "currency": normalize_currency(data.get("currency")),
+    }
+
+
+def spend_by_supplier_month(db, user_id, start=None, end=None):
+    """
+    Gasto total por proveedor, mes y moneda de un usuario, calculado en SQL
+    sobre las columnas tipadas. `start` / `end` (date) acotan invoice_date.
+    """
+    year = extract('year', Invoice.invoice_date).label('year')
+    month = extract('month', Invoice.invoice_date).label('month')
+    query = db.query(
+        Invoice.supplier,
+        year,
+        month,
+        Invoice.currency,
+        func.count(Invoice.id).label('invoices'),
+        func.sum(Invoice.total_amount).label('total'),
+    ).filter(
+        Invoice.user_id == user_id,
+        Invoice.invoice_date.isnot(None),
+    )
+    if start:
+        query = query.filter(Invoice.invoice_date >= start)
+    if end:
+        query = query.filter(Invoice.invoice_date <= end)
+    rows = query.group_by(Invoice.supplier, year, month, Invoice.currency).order_by(
+        year.desc(), month.desc(), func.sum(Invoice.total_amount).desc()
+    )
+    return [
+        {
+            "supplier": supplier,
+            "month": f"{int(y):04d}-{int(m):02d}",
+            "currency": currency,
+            "invoices": invoices,
+            "total": float(total) if total is not None else None,
+        }
+        for supplier, y, m, currency, invoices, total in rows
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Listado paginado de facturas (keyset sobre created_at, id)
+# ---------------------------------------------------------------------------
+
+# Columnas del resumen de una factura: nunca los textos de invoice_blobs
+INVOICE_SUMMARY_COLUMNS = (
+    Invoice.id,
+    Invoice.invoice_number,
+    Invoice.supplier,
+    Invoice.nit,
+    Invoice.date,
+    Invoice.total,
+    Invoice.invoice_date,
+    Invoice.total_amount,
+    Invoice.currency,
+    Invoice.created_at,
+)
+
+
+def encode_cursor(created_at, invoice_id):
+    """Cursor opaco con la posición (created_at, id) de la última factura de una página"""
+    raw = json.dumps([created_at.isoformat(), invoice_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Inverso de encode_cursor; ValueError si el cursor no es válido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, invoice_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(invoice_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Cursor inválido: {cursor!r}") from e
+
+
+def list_invoices(db, user_id=None, limit=20, cursor=None):
+    """
+    Página de facturas (más recientes primero) con solo las columnas del resumen.
+    Pagina por keyset sobre (created_at, id): cada página es un rango del índice,
+    así que cuesta lo mismo la primera que la milésima. `user_id=None` lista todas.
+    Devuelve (facturas, cursor de la página siguiente o None).
+    """
+    query = db.query(*INVOICE_SUMMARY_COLUMNS)
+    if user_id is not None:
+        query = query.filter(Invoice.user_id == user_id)
+    if cursor:
+        created_at, invoice_id = decode_cursor(cursor)
+        query = query.filter(tuple_(Invoice.created_at, Invoice.id) < tuple_(created_at, invoice_id))
+    rows = query.order_by(Invoice.created_at.desc(), Invoice.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    items = [
+        {
+            "id": row.id,
+            "invoice_number": row.invoice_number,
+            "supplier": row.supplier,
+            "nit": row.nit,
+            "date": row.date,
+            "total": row.total,
+            "invoice_date": row.invoice_date.isoformat() if row.invoice_date else None,
+            "total_amount": float(row.total_amount) if row.total_amount is not None else None,
+            "currency": row.currency,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+        }
+        for row in rows
+    ]
+    return items, next_cursor
+
+
+def count_invoices(db, user_id=None):
+    """Número de facturas (de un usuario o todas); se resuelve con un índice"""
+    query = db.query(func.count(Invoice.id))
+    if user_id is not None:
+        query = query.filter(Invoice.user_id == user_id)
+    return query.scalar()
+
+
+# ---------------------------------------------------------------------------
+# Búsqueda de texto completo (SQLite FTS5) sobre el texto OCR de las facturas
+# ---------------------------------------------------------------------------
+
+# rowid = invoices.id. La tabla es "contentless" (content=''): solo guarda el
+# índice, porque el texto ya está comprimido en invoice_blobs, y los fragmentos
+# se recortan en Python a partir del blob. Con SQLite >= 3.43 se borra por rowid
+# (contentless_delete=1); en versiones anteriores hay que pasar a FTS5 el texto
+# que se indexó (comando 'delete'), que se lee de la BD antes de cada flush.
+SEARCH_TABLE = "invoice_search"
+SEARCH_COLUMNS = ("invoice_number", "supplier", "nit", "raw_text")
+SEARCH_WEIGHTS = (5.0, 3.0, 3.0, 1.0)  # bm25: número y proveedor pesan más que el OCR
+SEARCH_TOKENIZER = "unicode61 remove_diacritics 2"
+SEARCH_MAX_TERMS = 8
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "80"))  # contexto a cada lado
+
+# Modo de borrado detectado por engine: "rowid" o "values" (ver _search_mode)
+_search_modes = {}
+
+
+def _create_search_table(conn):
+    """Crea la tabla FTS5 contentless; False si SQLite no tiene FTS5"""
+    columns = ", ".join(SEARCH_COLUMNS)
+    for options in ("content='', contentless_delete=1", "content=''"):
+        try:
+            conn.execute(text(
+                f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5({columns}, {options}, tokenize='{SEARCH_TOKENIZER}')"
+            ))
+            return True
+        except OperationalError as e:
+            error = e
+    print(f"⚠️  Búsqueda de texto completo desactivada (FTS5 no disponible): {error}")
+    return False
+
+
+def search_table_sql(conn):
+    """CREATE de la tabla de búsqueda tal como está en la BD (None si no existe)"""
+    return conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE name = :name"), {"name": SEARCH_TABLE}
+    ).scalar()
+
+
+def _search_mode(conn):
+    """
+    "rowid" si las entradas se pueden borrar por rowid (contentless_delete o una
+    tabla FTS5 normal de versiones anteriores), "values" si hay que pasar el texto
+    indexado, None si la BD no tiene tabla de búsqueda. Se consulta sqlite_master
+    una vez por engine, así indexa cualquier proceso aunque no llame a init_db.
+    """
+    if conn.dialect.name != "sqlite":
+        return None
+    mode = _search_modes.get(conn.engine)
+    if mode is None:
+        sql = search_table_sql(conn)
+        if sql is None:
+            return None  # No se cachea: puede crearse más tarde (init_db, migración)
+        mode = "values" if "content=''" in sql and "contentless_delete" not in sql else "rowid"
+        _search_modes[conn.engine] = mode
+    return mode
+
+
+def ensure_search_index(bind=None):
+    """Crea la tabla FTS5 si no existe. Sin FTS5 (o con otro motor) no hay búsqueda."""
+    bind = bind or engine
+    if bind.dialect.name != "sqlite":
+        return
+    with bind.begin() as conn:
+        if search_table_sql(conn) is None:
+            _create_search_table(conn)
+
+
+def search_enabled(bind=None):
+    with (bind or engine).connect() as conn:
+        return _search_mode(conn) is not None
+
+
+def _search_params(invoice_id, invoice_number, supplier, nit, raw_text):
+    return {
+        "rowid": invoice_id,
+        "invoice_number": invoice_number or "",
+        "supplier": supplier or "",
+        "nit": nit or "",
+        "raw_text": raw_text or "",
+    }
+
+
+_SEARCH_INSERT = text(
+    f"INSERT INTO {SEARCH_TABLE} (rowid, {', '.join(SEARCH_COLUMNS)}) "
+    f"VALUES (:rowid, {', '.join(':' + c for c in SEARCH_COLUMNS)})"
+)
+_SEARCH_DELETE = text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid")
+_SEARCH_DELETE_VALUES = text(
+    f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, {', '.join(SEARCH_COLUMNS)}) "
+    f"VALUES ('delete', :rowid, {', '.join(':' + c for c in SEARCH_COLUMNS)})"
+)
+_SEARCH_ROWS = text(
+    "SELECT i.id, i.invoice_number, i.supplier, i.nit, b.codec, b.raw_text_ocr_z "
+    "FROM invoices i LEFT JOIN invoice_blobs b ON b.invoice_id = i.id "
+    "WHERE i.id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+
+
+def _search_rows(conn, ids):
+    """Parámetros de indexación de las facturas `ids` tal como están en la BD"""
+    if not ids:
+        return []
+    return [
+        _search_params(invoice_id, number, supplier, nit, decompress_text(codec, raw) if codec else None)
+        for invoice_id, number, supplier, nit, codec, raw in conn.execute(_SEARCH_ROWS, {"ids": list(ids)})
+    ]
+
+
+def _changed_search_ids(session):
+    """
+    Ids de facturas ya guardadas cuyo texto indexado cambia en este flush
+    (columnas de Invoice o raw_text_ocr en InvoiceBlob) y de las que se borran.
+    """
+    changed, deleted = set(), set()
+    for obj in session.dirty:
+        if isinstance(obj, Invoice):
+            state = inspect(obj)
+            if any(state.attrs[c].history.has_changes() for c in ("invoice_number", "supplier", "nit")):
+                changed.add(obj.id)
+        elif isinstance(obj, InvoiceBlob):
+            if inspect(obj).attrs.raw_text_ocr_z.history.has_changes():
+                changed.add(obj.invoice_id)
+    for obj in session.new:
+        # Texto añadido a una factura guardada que no tenía blob
+        if isinstance(obj, InvoiceBlob) and obj.invoice is not None and obj.invoice.id is not None:
+            changed.add(obj.invoice.id)
+    for obj in session.deleted:
+        if isinstance(obj, Invoice):
+            deleted.add(obj.id)
+        elif isinstance(obj, InvoiceBlob):
+            changed.add(obj.invoice_id)
+    changed -= deleted
+    changed.discard(None)
+    deleted.discard(None)
+    return changed, deleted
+
+
+@event.listens_for(Session, "before_flush")
+def _collect_search_changes(session, flush_context, instances):
+    """Anota qué facturas reindexar y, si hace falta, el texto que tenían indexado"""
+    changed, deleted = _changed_search_ids(session)
+    if not changed and not deleted:
+        return
+    conn = session.connection()
+    mode = _search_mode(conn)
+    if mode is None:
+        return
+    old = _search_rows(conn, changed | deleted) if mode == "values" else []
+    session.info["search_pending"] = (changed, deleted, old)
+
+
+@event.listens_for(Session, "after_flush")
+def _apply_search_changes(session, flush_context):
+    """Actualiza el índice en la misma transacción que guarda las facturas"""
+    pending = session.info.pop("search_pending", None)
+    new_ids = {obj.id for obj in session.new if isinstance(obj, Invoice)}
+    if not pending and not new_ids:
+        return
+    conn = session.connection()
+    mode = _search_mode(conn)
+    if mode is None:
+        return
+    changed, deleted, old = pending or (set(), set(), [])
+    if mode == "values":
+        if old:
+            conn.execute(_SEARCH_DELETE_VALUES, old)
+    elif changed | deleted:
+        conn.execute(_SEARCH_DELETE, [{"rowid": i} for i in changed | deleted])
+    rows = _search_rows(conn, changed | new_ids)
+    if rows:
+        conn.execute(_SEARCH_INSERT, rows)
+
+
+def rebuild_search_index(conn, batch_size=500):
+    """
+    Vuelve a crear el índice (contentless) e indexa todas las facturas por lotes
+    (migraciones). Devuelve el número de facturas indexadas.
+    """
+    conn.execute(text(f"DROP TABLE IF EXISTS {SEARCH_TABLE}"))
+    if not _create_search_table(conn):
+        conn.commit()
+        return 0
+    conn.commit()
+    _search_modes.pop(conn.engine, None)
+    last_id = 0
+    indexed = 0
+    while True:
+        ids = conn.execute(
+            text("SELECT id FROM invoices WHERE id > :last_id ORDER BY id LIMIT :limit"),
+            {"last_id": last_id, "limit": batch_size},
+        ).scalars().all()
+        if not ids:
+            break
+        conn.execute(_SEARCH_INSERT, _search_rows(conn, ids))
+        conn.commit()
+        last_id = ids[-1]
+        indexed += len(ids)
+    return indexed
+
+
+def search_terms(query):
+    """Palabras de la consulta del usuario (se descarta la sintaxis de FTS5)"""
+    return re.findall(r"\w+", query or "")[:SEARCH_MAX_TERMS]
+
+
+def build_match_query(terms):
+    """Consulta FTS5 segura: todos los términos (AND) y el último como prefijo"""
+    if not terms:
+        return None
+    parts = [f'"{term}"' for term in terms]
+    parts[-1] += "*"
+    return " ".join(parts)
+
+
+def _fold(value):
+    """Minúsculas sin tildes, con la misma longitud que `value` (para ubicar coincidencias)"""
+    return "".join((unicodedata.normalize("NFKD", c.lower())[:1] or c) for c in value)
+
+
+def make_snippet(value, terms, context=SEARCH_SNIPPET_CHARS):
+    """
+    Fragmento de `value` alrededor de la primera coincidencia de `terms`, con las
+    coincidencias entre [corchetes]. Sin coincidencia (p. ej. solo en el
+    proveedor) devuelve el comienzo del texto.
+    """
+    if not value:
+        return ""
+    folded = _fold(value)
+    # Palabras completas, salvo la última que se busca como prefijo (igual que en FTS5)
+    alternatives = [re.escape(_fold(t)) + r"\b" for t in terms[:-1]] + [re.escape(_fold(terms[-1]))]
+    pattern = re.compile(r"\b(?:" + "|".join(alternatives) + ")")
+    first = pattern.search(folded)
+    if not first:
+        start, end = 0, min(len(value), 2 * context)
+    else:
+        start, end = max(0, first.start() - context), min(len(value), first.end() + context)
+    pieces = []
+    pos = start
+    for m in pattern.finditer(folded, start, end):
+        pieces.append(value[pos:m.start()])
+        pieces.append(f"[{value[m.start():m.end()]}]")
+        pos = m.end()
+    pieces.append(value[pos:end])
+    snippet = " ".join("".join(pieces).split())
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(value) else "")
+
+
+def search_invoices(db, user_id, query, limit=20):
+    """
+    Facturas de un usuario que contienen todas las palabras de `query`, ordenadas
+    por relevancia (bm25) con un fragmento del texto OCR. None si la BD no tiene
+    índice de búsqueda.
+    """
+    if _search_mode(db.connection()) is None:
+        return None
+    terms = search_terms(query)
+    match = build_match_query(terms)
+    if not match:
+        return []
+    weights = ", ".join(str(w) for w in SEARCH_WEIGHTS)
+    rows = db.execute(
+        text(
+            f"SELECT i.id, i.invoice_number, i.supplier, i.date, i.created_at, "
+            f"bm25({SEARCH_TABLE}, {weights}) AS score "
+            f"FROM {SEARCH_TABLE} JOIN invoices i ON i.id = {SEARCH_TABLE}.rowid "
+            f"WHERE {SEARCH_TABLE} MATCH :match AND i.user_id = :user_id "
+            f"ORDER BY score LIMIT :limit"
+        ),
+        {"match": match, "user_id": user_id, "limit": limit},
+    ).fetchall()
+    if not rows:
+        return []
+
+    # Solo se descomprime el texto de las facturas devueltas
+    blobs = {
+        invoice_id: decompress_text(codec, raw)
+        for invoice_id, codec, raw in db.query(
+            InvoiceBlob.invoice_id, InvoiceBlob.codec, InvoiceBlob.raw_text_ocr_z
+        ).filter(InvoiceBlob.invoice_id.in_([row[0] for row in rows]))
+    }
+    return [
+        {
+            "invoice_id": invoice_id,
+            "invoice_number": invoice_number,
+            "supplier": supplier,
+            "date": date_text,
+            "created_at": str(created_at) if created_at else None,
+            "score": round(-score, 4),  # bm25 es negativo: mayor = más relevante
+            "snippet": make_snippet(blobs.get(invoice_id), terms),
+        }
+        for invoice_id, invoice_number, supplier, date_text, created_at, score in rows
+    ]
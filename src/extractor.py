@@ -1,20 +1,137 @@
+import os
 import re
+import threading
 from datetime import datetime
-import spacy
 
-# Cargar modelo de spaCy (si está disponible)
-try:
-    nlp = spacy.load("es_core_news_sm")
-except:
-    nlp = None
-    print("Advertencia: Modelo spaCy no encontrado. Usa: python -m spacy download es_core_news_sm")
+# Modelo de spaCy para detectar el proveedor (entidades ORG). Se carga de forma
+# perezosa la primera vez que hace falta; con EXTRACTOR_USE_NER=0 no se carga
+# nunca y el proveedor se obtiene solo con las heurísticas por líneas.
+SPACY_MODEL = os.getenv("SPACY_MODEL", "es_core_news_sm")
+EXTRACTOR_USE_NER = os.getenv("EXTRACTOR_USE_NER", "1") != "0"
+# Solo usamos NER: el resto de componentes del pipeline ni se cargan
+SPACY_EXCLUDE = ["tagger", "morphologizer", "parser", "senter", "attribute_ruler", "lemmatizer"]
+# El proveedor se busca con NER solo en el inicio del documento
+SUPPLIER_NER_CHARS = 500
+
+_nlp = None
+_nlp_loaded = False
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    """
+    Devuelve el pipeline de spaCy compartido (solo NER), cargándolo en el
+    primer uso. None si NER está desactivado o el modelo no está disponible.
+    """
+    global _nlp, _nlp_loaded
+    if not EXTRACTOR_USE_NER:
+        return None
+    if not _nlp_loaded:
+        with _nlp_lock:
+            if not _nlp_loaded:
+                try:
+                    import spacy
+                    nlp = spacy.load(SPACY_MODEL, exclude=SPACY_EXCLUDE)
+                    # En los modelos "sm" NER lleva su propio tok2vec; el compartido sobra
+                    if "tok2vec" in nlp.pipe_names and \
+                            "ner" not in nlp.get_pipe("tok2vec").listening_components:
+                        nlp.remove_pipe("tok2vec")
+                    _nlp = nlp
+                except Exception:
+                    _nlp = None
+                    print(f"Advertencia: Modelo spaCy no encontrado. Usa: python -m spacy download {SPACY_MODEL}")
+                _nlp_loaded = True
+    return _nlp
+
+# Patrones de cada campo en orden de prioridad: gana el primer patrón que tenga
+# alguna coincidencia en el texto y, de ese patrón, la primera coincidencia.
+# Cada patrón va con los literales de los que necesita al menos uno para poder
+# coincidir (en minúsculas), o None si no tiene ninguno obligatorio.
+INVOICE_NUMBER_PATTERNS = [
+    (r'(?:factura|invoice|fact\.?)\s*(?:n[oº°]?\.?|#|num\.?)?[\s:]*([A-Z0-9\-]+)', ('fact', 'invoice')),
+    (r'(?:n[oº°]\.?\s*factura|fact\.?\s*n[oº°]\.?)[\s:]*([A-Z0-9\-]+)', ('fact',)),
+    (r'(?:^|\s)([A-Z]{2,4}\-?\d{6,})', None),  # Formato común: ABC-123456
+]
+
+MONTHS = ('enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto',
+          'septiembre', 'octubre', 'noviembre', 'diciembre')
+
+DATE_PATTERNS = [
+    (r'(?:fecha|date|f\.|emisión)[\s:]*(\d{1,2}[-/]\d{1,2}[-/]\d{2,4})', ('fecha', 'date', 'f.', 'emisión')),
+    (r'(\d{1,2}[-/]\d{1,2}[-/]\d{2,4})', None),
+    (rf'(\d{{1,2}}\s+(?:de\s+)?(?:{"|".join(MONTHS)})\s+(?:de\s+)?\d{{4}})', MONTHS),
+]
+
+NIT_PATTERNS = [
+    (r'(?:nit|ruc|rfc|cuit|tax\s*id)[\s:]*([0-9\.\-]{7,15})', ('nit', 'ruc', 'rfc', 'cuit', 'tax')),
+    (r'(?:identificación|id\.?)[\s:]*([0-9\.\-]{7,15})', ('id',)),
+]
+
+# (palabra clave, literal obligatorio)
+SUBTOTAL_KEYWORDS = [('subtotal', 'subtotal'), ('sub-total', 'sub-total'), (r'base\s+imponible', 'imponible')]
+TAX_KEYWORDS = [('iva', 'iva'), ('tax', 'tax'), ('impuesto', 'impuesto'), ('vat', 'vat')]
+TOTAL_KEYWORDS = [('total', 'total'), (r'total\s+a\s+pagar', 'pagar'),
+                  (r'importe\s+total', 'importe'), (r'monto\s+total', 'monto')]
+
+
+def _amount_patterns(keywords):
+    """Patrones de un monto monetario precedido por cada palabra clave"""
+    return [
+        (rf'(?:{keyword})[\s:$]*([0-9]+[,.]?[0-9]*\.?[0-9]{{2}})', (literal,))
+        for keyword, literal in keywords
+    ]
+
+
+def _compile_fields(fields):
+    """Compila una sola vez los patrones de todos los campos"""
+    return [
+        (field, [(re.compile(pattern, flags), literals) for pattern, literals in patterns])
+        for field, patterns, flags in fields
+    ]
+
+
+# El número de factura usa MULTILINE para que '^' coincida al inicio de cada línea
+FIELD_PATTERNS = _compile_fields([
+    ("invoice_number", INVOICE_NUMBER_PATTERNS, re.IGNORECASE | re.MULTILINE),
+    ("date", DATE_PATTERNS, re.IGNORECASE),
+    ("nit", NIT_PATTERNS, re.IGNORECASE),
+    ("subtotal", _amount_patterns(SUBTOTAL_KEYWORDS), re.IGNORECASE),
+    ("tax", _amount_patterns(TAX_KEYWORDS), re.IGNORECASE),
+    ("total", _amount_patterns(TOTAL_KEYWORDS), re.IGNORECASE),
+])
+
+# re.IGNORECASE compara la minúscula simple de cada carácter y además equipara
+# 'ı' con 'i' y 'ſ' con 's'; str.lower() convierte 'İ' en 'i' + punto combinante.
+# El texto se normaliza igual para que el prefiltro de literales nunca descarte
+# un patrón que sí coincidiría.
+_IGNORECASE_FIXES = (('ı', 'i'), ('ſ', 's'), ('\u0307', ''))
+
+
+def _fold(text):
+    """Texto en minúsculas comparable con los literales obligatorios"""
+    folded = text.lower()
+    if not folded.isascii():
+        for char, replacement in _IGNORECASE_FIXES:
+            if char in folded:
+                folded = folded.replace(char, replacement)
+    return folded
+
+
+def _org_entities(doc):
+    """Textos de las entidades ORG de un Doc de spaCy"""
+    return [ent.text for ent in doc.ents if ent.label_ == "ORG"]
+
 
 class InvoiceExtractor:
     """Extrae campos estructurados de texto OCR de facturas"""
     
-    def __init__(self, text):
+    def __init__(self, text, supplier_orgs=None):
         self.text = text
         self.lines = text.splitlines()
+        self._candidates = None
+        # Entidades ORG ya calculadas (p. ej. por extract_invoice_data_batch);
+        # None = ejecutar spaCy sobre este texto al extraer el proveedor
+        self._supplier_orgs = supplier_orgs
         
     def extract_all(self):
         """Extrae todos los campos de la factura"""
@@ -29,34 +146,37 @@ class InvoiceExtractor:
             "raw_text": self.text
         }
     
+    def _scan(self):
+        """
+        Resuelve de una vez todos los campos basados en regex.
+
+        Los literales obligatorios se comprueban contra una única copia del
+        texto en minúsculas, de modo que solo se ejecutan las regex que pueden
+        coincidir; el resultado se guarda para el resto de extract_*.
+        """
+        if self._candidates is None:
+            folded = _fold(self.text)
+            candidates = {}
+            for field, patterns in FIELD_PATTERNS:
+                for pattern, literals in patterns:
+                    if literals is not None and not any(lit in folded for lit in literals):
+                        continue
+                    match = pattern.search(self.text)
+                    if match:
+                        candidates[field] = match.group(1)
+                        break
+            self._candidates = candidates
+        return self._candidates
+
     def extract_invoice_number(self):
         """Extrae el número de factura"""
-        patterns = [
-            r'(?:factura|invoice|fact\.?)\s*(?:n[oº°]?\.?|#|num\.?)?[\s:]*([A-Z0-9\-]+)',
-            r'(?:n[oº°]\.?\s*factura|fact\.?\s*n[oº°]\.?)[\s:]*([A-Z0-9\-]+)',
-            r'(?:^|\s)([A-Z]{2,4}\-?\d{6,})',  # Formato común: ABC-123456
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, self.text, re.IGNORECASE | re.MULTILINE)
-            if match:
-                return match.group(1).strip()
-        return None
+        value = self._scan().get("invoice_number")
+        return value.strip() if value is not None else None
     
     def extract_date(self):
         """Extrae la fecha de emisión"""
-        patterns = [
-            r'(?:fecha|date|f\.|emisión)[\s:]*(\d{1,2}[-/]\d{1,2}[-/]\d{2,4})',
-            r'(\d{1,2}[-/]\d{1,2}[-/]\d{2,4})',
-            r'(\d{1,2}\s+(?:de\s+)?(?:enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre)\s+(?:de\s+)?\d{4})',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, self.text, re.IGNORECASE)
-            if match:
-                date_str = match.group(1).strip()
-                return self._normalize_date(date_str)
-        return None
+        value = self._scan().get("date")
+        return self._normalize_date(value.strip()) if value is not None else None
     
     def _normalize_date(self, date_str):
         """Normaliza diferentes formatos de fecha"""
@@ -73,11 +193,13 @@ class InvoiceExtractor:
     def extract_supplier(self):
         """Extrae el nombre del proveedor"""
         # Buscar usando spaCy si está disponible
-        if nlp:
-            doc = nlp(self.text[:500])  # Primeros 500 caracteres
-            orgs = [ent.text for ent in doc.ents if ent.label_ == "ORG"]
-            if orgs:
-                return orgs[0]
+        orgs = self._supplier_orgs
+        if orgs is None:
+            nlp = get_nlp()
+            if nlp:
+                orgs = _org_entities(nlp(self.text[:SUPPLIER_NER_CHARS]))  # Primeros 500 caracteres
+        if orgs:
+            return orgs[0]
         
         # Fallback: buscar líneas superiores con palabras clave
         for i, line in enumerate(self.lines[:15]):  # Primeras 15 líneas
@@ -92,44 +214,56 @@ class InvoiceExtractor:
     
     def extract_nit(self):
         """Extrae el NIT o identificación fiscal"""
-        patterns = [
-            r'(?:nit|ruc|rfc|cuit|tax\s*id)[\s:]*([0-9\.\-]{7,15})',
-            r'(?:identificación|id\.?)[\s:]*([0-9\.\-]{7,15})',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, self.text, re.IGNORECASE)
-            if match:
-                return match.group(1).strip()
-        return None
+        value = self._scan().get("nit")
+        return value.strip() if value is not None else None
     
     def extract_subtotal(self):
         """Extrae el subtotal"""
-        return self._extract_amount(['subtotal', 'sub-total', 'base\s+imponible'])
+        return self._extract_amount("subtotal")
     
     def extract_tax(self):
         """Extrae el impuesto (IVA, TAX, etc.)"""
-        return self._extract_amount(['iva', 'tax', 'impuesto', 'vat'])
+        return self._extract_amount("tax")
     
     def extract_total(self):
         """Extrae el total"""
-        return self._extract_amount(['total', 'total\s+a\s+pagar', 'importe\s+total', 'monto\s+total'])
+        return self._extract_amount("total")
     
-    def _extract_amount(self, keywords):
-        """Extrae un monto monetario dado una lista de palabras clave"""
-        for keyword in keywords:
-            # Patrón mejorado para capturar montos
-            pattern = rf'(?:{keyword})[\s:$]*([0-9]+[,.]?[0-9]*\.?[0-9]{{2}})'
-            match = re.search(pattern, self.text, re.IGNORECASE)
-            if match:
-                amount = match.group(1).strip()
-                # Normalizar formato (reemplazar comas por puntos)
-                amount = amount.replace(',', '')
-                return amount
-        return None
+    def _extract_amount(self, field):
+        """Devuelve el monto monetario encontrado para un campo"""
+        amount = self._scan().get(field)
+        if amount is None:
+            return None
+        # Normalizar formato (reemplazar comas por puntos)
+        return amount.strip().replace(',', '')
 
 
 def extract_invoice_data(text):
     """Función helper para extraer datos de una factura"""
     extractor = InvoiceExtractor(text)
-    return extractor.extract_all()
\ No newline at end of file
+    return extractor.extract_all()
+
+
+def extract_invoice_data_batch(texts, batch_size=64, n_process=1):
+    """
+    Extrae los datos de muchas facturas a la vez.
+
+    El NER del proveedor se ejecuta con nlp.pipe (por lotes de `batch_size` y,
+    si n_process > 1, en varios procesos) en lugar de una llamada por factura.
+    Devuelve una lista de dicts en el mismo orden que `texts`.
+    """
+    texts = list(texts)
+    nlp = get_nlp()
+    if nlp:
+        docs = nlp.pipe(
+            (text[:SUPPLIER_NER_CHARS] for text in texts),
+            batch_size=batch_size,
+            n_process=n_process,
+        )
+        all_orgs = [_org_entities(doc) for doc in docs]
+    else:
+        all_orgs = [[] for _ in texts]
+    return [
+        InvoiceExtractor(text, supplier_orgs=orgs).extract_all()
+        for text, orgs in zip(texts, all_orgs)
+    ]
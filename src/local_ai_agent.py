@@ -1,60 +1,580 @@
 import os
 import json
-from typing import Dict, Any, Optional, List
-
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from typing import AsyncIterator, Dict, Any, Optional, List
+
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 LMSTUDIO_BASE_URL = os.getenv("LMSTUDIO_BASE_URL", "http://127.0.0.1:1234/v1")
 LMSTUDIO_API_KEY = os.getenv("LMSTUDIO_API_KEY", "lmstudio-key")
 LMSTUDIO_MODEL = os.getenv("LMSTUDIO_MODEL", "llama-3.2-3b-instruct")
 
+# Conexiones HTTP reutilizables (keep-alive) hacia LM Studio: tamaño del pool,
+# timeouts de conexión y de lectura (segundos) y reintentos con backoff
+# exponencial ante errores de conexión o respuestas 5xx
+LMSTUDIO_POOL_SIZE = int(os.getenv("LMSTUDIO_POOL_SIZE", "8"))
+LMSTUDIO_CONNECT_TIMEOUT = float(os.getenv("LMSTUDIO_CONNECT_TIMEOUT", "5"))
+LMSTUDIO_READ_TIMEOUT = float(os.getenv("LMSTUDIO_READ_TIMEOUT", "60"))
+LMSTUDIO_RETRIES = int(os.getenv("LMSTUDIO_RETRIES", "2"))
+LMSTUDIO_BACKOFF = float(os.getenv("LMSTUDIO_BACKOFF", "0.5"))
+
+RETRY_STATUS = (500, 502, 503, 504)
+
+# Caché persistente de respuestas del modelo (las peticiones son deterministas a
+# baja temperatura). Solo se cachean llamadas con temperature <= LLM_CACHE_MAX_TEMPERATURE.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join("data", "llm_cache.sqlite3"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL_HOURS", "168")) * 3600
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.3"))
+
+# Presupuesto de tokens del prompt (estimados como caracteres / 4). El historial
+# puede ocupar como máximo HISTORY_TOKEN_SHARE del presupuesto; si el texto OCR
+# no cabe en lo que queda, se conservan solo las líneas más relevantes.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+HISTORY_TOKEN_SHARE = float(os.getenv("HISTORY_TOKEN_SHARE", "0.25"))
+MIN_OCR_TOKENS = 256
+CHARS_PER_TOKEN = 4
+HEADER_LINES = 5  # primeras líneas no vacías (emisor, NIT...) que siempre se conservan
+
+# Registrar tamaño del prompt y latencia de cada llamada al modelo
+LLM_LOG = os.getenv("LLM_LOG", "1") != "0"
+
+# Palabras que delatan líneas con campos de factura
+FIELD_HINTS = (
+    "factura", "invoice", "no.", "n°", "nº", "número", "numero", "nit", "ruc", "rfc",
+    "fecha", "período", "periodo", "vence", "vencimiento", "total", "subtotal", "iva",
+    "impuesto", "tax", "valor", "pagar", "$", "cop", "usd", "eur", "s.a", "sas", "ltda",
+    "contrato", "cliente", "referencia",
+)
+
 
 class LocalAIAgentError(Exception):
     """Error genérico del agente de IA local."""
 
 
-def _chat(messages, temperature: float = 0.2, max_tokens: int = 1024) -> str:
+class LLMCache:
     """
-    Llama al servidor local de LM Studio usando la API compatible con OpenAI.
-    Espera que LM Studio esté corriendo en LMSTUDIO_BASE_URL.
+    Caché en disco (SQLite) de respuestas de _chat con caducidad (TTL) y
+    expulsión LRU acotada por número de entradas. Segura entre hilos y procesos.
     """
-    url = f"{LMSTUDIO_BASE_URL}/chat/completions"
 
-    headers = {
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            with self._lock:
+                conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        response TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_used REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used);
+                    """
+                )
+                self._initialized = True
+        return conn
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str) -> Optional[str]:
+        """Devuelve la respuesta guardada o None si no existe o ha caducado"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                with conn:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._count(False)
+                return None
+            with conn:
+                conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._count(True)
+            return row[0]
+        finally:
+            conn.close()
+
+    def put(self, key: str, response: str) -> None:
+        """Guarda una respuesta y aplica la caducidad y la expulsión LRU"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, response, now, now),
+                )
+                conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+                conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._connect()
+        try:
+            entries = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        finally:
+            conn.close()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+        }
+
+
+_llm_cache: Optional[LLMCache] = None
+
+
+def get_llm_cache() -> Optional[LLMCache]:
+    """Devuelve la caché de respuestas compartida (None si está desactivada)"""
+    global _llm_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    if _llm_cache is None:
+        try:
+            os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+        except OSError as e:
+            print(f"⚠️ Caché LLM no disponible: {e}")
+            return None
+        _llm_cache = LLMCache()
+    return _llm_cache
+
+
+def _cache_get(cache: LLMCache, key: str) -> Optional[str]:
+    """Lee de la caché; si falla (BD bloqueada, sin permisos...) sigue sin caché"""
+    try:
+        return cache.get(key)
+    except Exception as e:
+        print(f"⚠️ Caché LLM no disponible: {e}")
+        return None
+
+
+def _cache_put(cache: LLMCache, key: str, content: str) -> None:
+    """Guarda en la caché; un error no impide devolver la respuesta del modelo"""
+    try:
+        cache.put(key, content)
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar en la caché LLM: {e}")
+
+
+def cache_stats() -> Dict[str, Any]:
+    """Aciertos, fallos y número de entradas de la caché de respuestas"""
+    cache = get_llm_cache()
+    if cache is None:
+        return {"enabled": False}
+    try:
+        return {"enabled": True, **cache.stats()}
+    except Exception as e:
+        return {"enabled": True, "error": str(e)}
+
+
+def _cache_key(payload: Dict[str, Any]) -> Optional[str]:
+    """Clave de caché: hash del modelo, los mensajes, la temperatura y max_tokens"""
+    if payload["temperature"] > LLM_CACHE_MAX_TEMPERATURE:
+        return None
+    blob = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+# Cliente asíncrono por event loop (un AsyncClient no se puede compartir entre loops)
+_async_clients: Dict[int, httpx.AsyncClient] = {}
+
+
+def _headers() -> Dict[str, str]:
+    return {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {LMSTUDIO_API_KEY}",
     }
 
-    payload = {
+
+def get_session() -> requests.Session:
+    """
+    Sesión HTTP compartida (segura entre hilos) con pool de conexiones
+    keep-alive y reintentos con backoff.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(
+                    total=LMSTUDIO_RETRIES,
+                    connect=LMSTUDIO_RETRIES,
+                    read=0,  # no repetir una generación que ya pudo haberse hecho
+                    status=LMSTUDIO_RETRIES,
+                    status_forcelist=RETRY_STATUS,
+                    allowed_methods=frozenset({"POST"}),
+                    backoff_factor=LMSTUDIO_BACKOFF,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=LMSTUDIO_POOL_SIZE,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.headers.update(_headers())
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Cliente asíncrono con pool de conexiones keep-alive para el event loop actual"""
+    loop_id = id(asyncio.get_running_loop())
+    client = _async_clients.get(loop_id)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            headers=_headers(),
+            timeout=httpx.Timeout(LMSTUDIO_READ_TIMEOUT, connect=LMSTUDIO_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=LMSTUDIO_POOL_SIZE,
+                max_keepalive_connections=LMSTUDIO_POOL_SIZE,
+            ),
+            # httpx solo reintenta fallos de conexión; los 5xx se reintentan en _achat
+            transport=httpx.AsyncHTTPTransport(retries=LMSTUDIO_RETRIES),
+        )
+        _async_clients[loop_id] = client
+    return client
+
+
+async def aclose_async_client() -> None:
+    """Cierra el cliente asíncrono del event loop actual (al apagar el servidor)"""
+    client = _async_clients.pop(id(asyncio.get_running_loop()), None)
+    if client is not None:
+        await client.aclose()
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata del número de tokens de un texto (~4 caracteres por token)"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _log_call(messages, start: float, cached: bool = False, first_token: Optional[float] = None) -> None:
+    if not LLM_LOG:
+        return
+    tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    chars = sum(len(m["content"]) for m in messages)
+    origen = " (caché)" if cached else ""
+    primero = f", primer token {first_token - start:.2f}s" if first_token is not None else ""
+    print(
+        f"🤖 LLM: prompt ~{tokens} tokens ({chars} caracteres), "
+        f"{time.perf_counter() - start:.2f}s{primero}{origen}"
+    )
+
+
+def _chat_payload(messages, temperature: float, max_tokens: int) -> Dict[str, Any]:
+    return {
         "model": LMSTUDIO_MODEL,
         "messages": messages,
         "temperature": temperature,
         "max_tokens": max_tokens,
     }
 
-    try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
-    except Exception as e:
-        raise LocalAIAgentError(f"No se pudo conectar al servidor LM Studio en {url}: {e}")
 
-    if resp.status_code != 200:
+def _chat_content(status_code: int, text: str, data_fn) -> str:
+    """Valida la respuesta de LM Studio y devuelve el contenido del mensaje"""
+    if status_code != 200:
         raise LocalAIAgentError(
-            f"Respuesta no exitosa de LM Studio ({resp.status_code}): {resp.text[:500]}"
+            f"Respuesta no exitosa de LM Studio ({status_code}): {text[:500]}"
         )
 
-    data = resp.json()
+    data = data_fn()
     try:
         return data["choices"][0]["message"]["content"]
     except Exception as e:
         raise LocalAIAgentError(f"Formato de respuesta inesperado de LM Studio: {e} - {data}")
 
 
-def extraer_datos_con_ia(raw_text: str, historial_usuario: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+def _chat(messages, temperature: float = 0.2, max_tokens: int = 1024) -> str:
     """
-    Extrae TODOS los datos de la factura directamente del texto OCR usando el modelo.
-    Esta es la función principal que debe usarse para determinar los campos.
+    Llama al servidor local de LM Studio usando la API compatible con OpenAI.
+    Espera que LM Studio esté corriendo en LMSTUDIO_BASE_URL.
     """
+    url = f"{LMSTUDIO_BASE_URL}/chat/completions"
+    payload = _chat_payload(messages, temperature, max_tokens)
+
+    start = time.perf_counter()
+    cache = get_llm_cache()
+    key = _cache_key(payload) if cache else None
+    if key:
+        cached = _cache_get(cache, key)
+        if cached is not None:
+            _log_call(messages, start, cached=True)
+            return cached
+
+    try:
+        resp = get_session().post(
+            url,
+            json=payload,
+            timeout=(LMSTUDIO_CONNECT_TIMEOUT, LMSTUDIO_READ_TIMEOUT),
+        )
+    except Exception as e:
+        raise LocalAIAgentError(f"No se pudo conectar al servidor LM Studio en {url}: {e}")
+
+    content = _chat_content(resp.status_code, resp.text, resp.json)
+    _log_call(messages, start)
+    if key:
+        _cache_put(cache, key, content)
+    return content
+
+
+async def _achat(messages, temperature: float = 0.2, max_tokens: int = 1024) -> str:
+    """Versión asíncrona de _chat (para el servidor FastAPI)"""
+    url = f"{LMSTUDIO_BASE_URL}/chat/completions"
+    payload = _chat_payload(messages, temperature, max_tokens)
+
+    start = time.perf_counter()
+    cache = get_llm_cache()
+    key = _cache_key(payload) if cache else None
+    if key:
+        cached = await asyncio.get_running_loop().run_in_executor(None, _cache_get, cache, key)
+        if cached is not None:
+            _log_call(messages, start, cached=True)
+            return cached
+
+    for attempt in range(LMSTUDIO_RETRIES + 1):
+        try:
+            resp = await get_async_client().post(url, json=payload)
+        except Exception as e:
+            raise LocalAIAgentError(f"No se pudo conectar al servidor LM Studio en {url}: {e}")
+        if resp.status_code not in RETRY_STATUS or attempt == LMSTUDIO_RETRIES:
+            break
+        await asyncio.sleep(LMSTUDIO_BACKOFF * (2 ** attempt))
+
+    content = _chat_content(resp.status_code, resp.text, resp.json)
+    _log_call(messages, start)
+    if key:
+        await asyncio.get_running_loop().run_in_executor(None, _cache_put, cache, key, content)
+    return content
+
+
+async def _achat_stream(messages, temperature: float = 0.2, max_tokens: int = 1024) -> AsyncIterator[str]:
+    """
+    Como _achat pero en modo `stream: true`: va devolviendo los fragmentos de
+    texto según los genera el modelo. Si quien consume deja de iterar (p. ej.
+    el cliente HTTP se desconecta), la conexión se cierra y LM Studio deja de generar.
+    """
+    url = f"{LMSTUDIO_BASE_URL}/chat/completions"
+    payload = _chat_payload(messages, temperature, max_tokens)
+    loop = asyncio.get_running_loop()
+
+    start = time.perf_counter()
+    cache = get_llm_cache()
+    key = _cache_key(payload) if cache else None
+    if key:
+        cached = await loop.run_in_executor(None, _cache_get, cache, key)
+        if cached is not None:
+            _log_call(messages, start, cached=True)
+            yield cached
+            return
+
+    first_token = None
+    parts: List[str] = []
+    try:
+        async with get_async_client().stream("POST", url, json={**payload, "stream": True}) as resp:
+            if resp.status_code != 200:
+                body = (await resp.aread()).decode("utf-8", "replace")
+                raise LocalAIAgentError(f"Respuesta no exitosa de LM Studio ({resp.status_code}): {body[:500]}")
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                except (json.JSONDecodeError, KeyError, IndexError) as e:
+                    raise LocalAIAgentError(f"Formato de respuesta inesperado de LM Studio: {e} - {data}")
+                if delta:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    parts.append(delta)
+                    yield delta
+    except httpx.HTTPError as e:
+        raise LocalAIAgentError(f"No se pudo conectar al servidor LM Studio en {url}: {e}")
+
+    _log_call(messages, start, first_token=first_token)
+    if key:
+        await loop.run_in_executor(None, _cache_put, cache, key, "".join(parts))
+
+
+def _parse_json_content(content: str) -> Dict[str, Any]:
+    """Parsea la respuesta del modelo como JSON de forma robusta"""
+    content_stripped = content.strip()
+    # Por si el modelo rodea el JSON con texto, buscar el primer '{' y el último '}'
+    if not content_stripped.startswith("{"):
+        start = content_stripped.find("{")
+        end = content_stripped.rfind("}")
+        if start != -1 and end != -1 and end > start:
+            content_stripped = content_stripped[start : end + 1]
+
+    try:
+        return json.loads(content_stripped)
+    except json.JSONDecodeError as e:
+        raise LocalAIAgentError(f"No se pudo parsear la respuesta como JSON: {e}\nRespuesta: {content}")
+
+
+def _strip_raw_text(obj):
+    """Copia de `obj` sin los textos OCR completos (raw_text / raw_text_ocr)"""
+    if isinstance(obj, dict):
+        return {k: _strip_raw_text(v) for k, v in obj.items() if k not in ("raw_text", "raw_text_ocr")}
+    if isinstance(obj, list):
+        return [_strip_raw_text(v) for v in obj]
+    return obj
+
+
+def _compact_json(data: Any, drop_empty: bool = False) -> str:
+    """JSON en una sola línea, sin texto OCR y opcionalmente sin campos vacíos"""
+    data = _strip_raw_text(data)
+    if drop_empty and isinstance(data, dict):
+        data = {k: v for k, v in data.items() if v not in (None, "", [], {})}
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _line_score(line: str, terms) -> int:
+    lower = line.lower()
+    score = sum(1 for hint in FIELD_HINTS if hint in lower)
+    score += 2 * sum(1 for term in terms if term in lower)
+    if any(c.isdigit() for c in line):
+        score += 1
+    return score
+
+
+def select_relevant_lines(raw_text: str, max_tokens: int, terms=()) -> str:
+    """
+    Recorta el texto OCR a `max_tokens` conservando el encabezado y las líneas
+    con más pistas de campos de factura (o de los `terms` de una pregunta), en
+    su orden original. Una línea que no cabe entera se corta al presupuesto
+    restante (un texto sin saltos de línea es una sola línea). Los huecos y los
+    cortes se marcan con "[...]".
+    """
+    if estimate_tokens(raw_text) <= max_tokens:
+        return raw_text
+
+    lines = [line.strip() for line in raw_text.splitlines()]
+    scores = [0] * len(lines)
+    header = 0
+    previous = 0
+    for i, line in enumerate(lines):
+        if not line:
+            continue
+        if header < HEADER_LINES:
+            score = 100
+            header += 1
+        else:
+            score = _line_score(line, terms)
+        # El valor suele ir en la línea siguiente a su etiqueta ("TOTAL A PAGAR" / "$ 1.234")
+        scores[i] = max(score, previous - 1)
+        previous = score
+
+    budget = max_tokens * CHARS_PER_TOKEN
+    keep = set()
+    cut = set()
+    used = 0
+    for i in sorted((i for i in range(len(lines)) if scores[i] > 0), key=lambda i: (-scores[i], i)):
+        cost = len(lines[i]) + 1
+        if used + cost <= budget:
+            keep.add(i)
+            used += cost
+        elif budget - used > 1:
+            lines[i] = lines[i][:budget - used - 1]
+            keep.add(i)
+            cut.add(i)
+            used = budget
+
+    out = []
+    last = -1
+    for i in sorted(keep):
+        if i != last + 1 or last in cut:
+            out.append("[...]")
+        out.append(lines[i])
+        last = i
+    if last != len(lines) - 1 or last in cut:
+        out.append("[...]")
+    return "\n".join(out)
+
+
+def _history_context(
+    historial: Optional[List[Dict[str, Any]]],
+    limit: int,
+    header: str,
+    label: str,
+    data_label: str,
+    footer: str,
+    max_tokens: int,
+) -> str:
+    """Bloque de facturas anteriores con datos compactos, dentro de `max_tokens`"""
+    if not historial:
+        return ""
+    used = estimate_tokens(header + footer)
+    entries = []
+    for i, fact in enumerate(historial[:limit], 1):
+        entry = (
+            f"\n{label} {i}:\n"
+            f"- Número: {fact.get('invoice_number', 'N/A')}\n"
+            f"- Emisor: {fact.get('supplier', 'N/A')}\n"
+            f"- Fecha: {fact.get('date', 'N/A')}\n"
+        )
+        if fact.get('data'):
+            entry += f"- {data_label}: {_compact_json(fact['data'], drop_empty=True)}\n"
+        cost = estimate_tokens(entry)
+        if used + cost > max_tokens:
+            break
+        entries.append(entry)
+        used += cost
+    if not entries:
+        return ""
+    return header + "".join(entries) + footer
+
+
+def _ocr_budget(*fixed_parts: str) -> int:
+    """Tokens disponibles para el texto OCR una vez descontado el resto del prompt"""
+    fixed = sum(estimate_tokens(part) for part in fixed_parts)
+    return max(PROMPT_TOKEN_BUDGET - fixed, MIN_OCR_TOKENS)
+
+
+def _extraction_messages(raw_text: str, historial_usuario: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, str]]:
+    """Mensajes para extraer los datos de la factura a partir del texto OCR"""
     system_prompt = (
         "Eres un asistente experto en analizar facturas. "
         "Analiza el texto OCR completo de una factura y extrae TODOS los campos relevantes. "
@@ -68,92 +588,90 @@ def extraer_datos_con_ia(raw_text: str, historial_usuario: Optional[List[Dict[st
         "Responde ÚNICAMENTE con un JSON válido, sin texto adicional."
     )
 
-    # Construir contexto histórico si está disponible
-    contexto_historico = ""
-    if historial_usuario and len(historial_usuario) > 0:
-        contexto_historico = (
+    # Construir contexto histórico si está disponible (máximo 3 ejemplos)
+    contexto_historico = _history_context(
+        historial_usuario,
+        limit=3,
+        header=(
             "\n\nCONTEXTO: Facturas anteriores procesadas por este usuario:\n"
             "============================================================\n"
-        )
-        for i, fact in enumerate(historial_usuario[:3], 1):  # Máximo 3 ejemplos
-            contexto_historico += (
-                f"\nEjemplo {i}:\n"
-                f"- Número: {fact.get('invoice_number', 'N/A')}\n"
-                f"- Emisor: {fact.get('supplier', 'N/A')}\n"
-                f"- Fecha: {fact.get('date', 'N/A')}\n"
-            )
-            if fact.get('data'):
-                contexto_historico += f"- Datos extraídos: {json.dumps(fact['data'], ensure_ascii=False, indent=2)}\n"
-        contexto_historico += (
+        ),
+        label="Ejemplo",
+        data_label="Datos extraídos",
+        footer=(
             "\nUsa estos ejemplos como referencia para entender el formato y estilo "
             "de las facturas que este usuario suele procesar. Si encuentras patrones similares, "
             "aplica la misma lógica de extracción.\n"
+        ),
+        max_tokens=int(PROMPT_TOKEN_BUDGET * HISTORY_TOKEN_SHARE),
+    )
+
+    def user_prompt(texto: str) -> str:
+        return (
+            "Texto OCR completo de la factura:\n"
+            "================================\n"
+            f"{texto}\n"
+            f"{contexto_historico}\n"
+            "Analiza este texto y extrae TODOS los campos de la factura. "
+            "Busca en cualquier parte del documento: encabezados, pies de página, secciones intermedias, etc. "
+            "Si tienes contexto de facturas anteriores del mismo usuario, úsalo para mejorar la precisión.\n\n"
+            "Devuelve un JSON con al menos estos campos (puedes añadir más si lo consideras importante):\n"
+            "{\n"
+            '  "invoice_number": string | null,        // Número de factura, puede estar como "FACTURA N°", "NÚMERO", "NO.", etc.\n'
+            '  "date": string | null,                  // Fecha de emisión. Si encuentras "PERÍODO: SEPTIEMBRE - 2025", úsalo como fecha. Formato preferido: YYYY-MM-DD o YYYY-MM\n'
+            '  "supplier": string | null,              // Nombre de la empresa o entidad que EMITE la factura (ej. Gases del Caribe, Claro, banco, etc.)\n'
+            '  "nit": string | null,                   // NIT, RUC, RFC, o identificación fiscal\n'
+            '  "subtotal": number | null,              // Subtotal antes de impuestos\n'
+            '  "tax": number | null,                   // IVA, impuestos, tax\n'
+            '  "total": number | null,                 // Total a pagar\n'
+            '  "currency": string | null,              // Moneda (COP, USD, EUR, etc.)\n'
+            '  "payment_terms": string | null,         // Condiciones de pago si aparecen\n'
+            '  "document_title": string | null         // Título o descripción general del documento, si existe\n'
+            "}\n\n"
+            "SI VES otros datos claramente importantes (número de contrato, período de facturación, servicio, "
+            "cliente/receptor de la factura, dirección, etc.), añade campos adicionales con nombres claros en inglés en snake_case "
+            "(por ejemplo: \"contract_number\", \"billing_period\", \"service_name\").\n\n"
+            "IMPORTANTE: Si ves 'PERÍODO: SEPTIEMBRE - 2025' o similar, mapea eso al campo 'date'. "
+            "Si ves 'FECHA', 'FECHA DE EMISIÓN', 'FECHA DE FACTURACIÓN', etc., úsalo para 'date'. "
+            "Responde solo con JSON puro, sin comentarios ni texto fuera del JSON."
         )
 
-    user_prompt = (
-        "Texto OCR completo de la factura:\n"
-        "================================\n"
-        f"{raw_text}\n"
-        f"{contexto_historico}\n"
-        "Analiza este texto y extrae TODOS los campos de la factura. "
-        "Busca en cualquier parte del documento: encabezados, pies de página, secciones intermedias, etc. "
-        "Si tienes contexto de facturas anteriores del mismo usuario, úsalo para mejorar la precisión.\n\n"
-        "Devuelve un JSON con al menos estos campos (puedes añadir más si lo consideras importante):\n"
-        "{\n"
-        '  "invoice_number": string | null,        // Número de factura, puede estar como "FACTURA N°", "NÚMERO", "NO.", etc.\n'
-        '  "date": string | null,                  // Fecha de emisión. Si encuentras "PERÍODO: SEPTIEMBRE - 2025", úsalo como fecha. Formato preferido: YYYY-MM-DD o YYYY-MM\n'
-        '  "supplier": string | null,              // Nombre de la empresa o entidad que EMITE la factura (ej. Gases del Caribe, Claro, banco, etc.)\n'
-        '  "nit": string | null,                   // NIT, RUC, RFC, o identificación fiscal\n'
-        '  "subtotal": number | null,              // Subtotal antes de impuestos\n'
-        '  "tax": number | null,                   // IVA, impuestos, tax\n'
-        '  "total": number | null,                 // Total a pagar\n'
-        '  "currency": string | null,              // Moneda (COP, USD, EUR, etc.)\n'
-        '  "payment_terms": string | null,         // Condiciones de pago si aparecen\n'
-        '  "raw_text": string,                     // Incluye aquí el texto OCR completo\n'
-        '  "document_title": string | null         // Título o descripción general del documento, si existe\n'
-        "}\n\n"
-        "SI VES otros datos claramente importantes (número de contrato, período de facturación, servicio, "
-        "cliente/receptor de la factura, dirección, etc.), añade campos adicionales con nombres claros en inglés en snake_case "
-        "(por ejemplo: \"contract_number\", \"billing_period\", \"service_name\").\n\n"
-        "IMPORTANTE: Si ves 'PERÍODO: SEPTIEMBRE - 2025' o similar, mapea eso al campo 'date'. "
-        "Si ves 'FECHA', 'FECHA DE EMISIÓN', 'FECHA DE FACTURACIÓN', etc., úsalo para 'date'. "
-        "Responde solo con JSON puro, sin comentarios ni texto fuera del JSON."
-    )
+    texto = select_relevant_lines(raw_text, _ocr_budget(system_prompt, user_prompt("")))
 
-    content = _chat(
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.1,
-        max_tokens=1000,
-    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt(texto)},
+    ]
 
-    # Intentar parsear como JSON robustamente
-    content_stripped = content.strip()
-    if not content_stripped.startswith("{"):
-        start = content_stripped.find("{")
-        end = content_stripped.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            content_stripped = content_stripped[start : end + 1]
 
-    try:
-        data = json.loads(content_stripped)
-    except json.JSONDecodeError as e:
-        raise LocalAIAgentError(f"No se pudo parsear la respuesta como JSON: {e}\nRespuesta: {content}")
+def _parse_extraction(content: str, raw_text: str) -> Dict[str, Any]:
+    data = _parse_json_content(content)
 
-    # Asegurar que al menos devolvemos raw_text y no perdemos campos extra
-    if "raw_text" not in data or not data.get("raw_text"):
-        data["raw_text"] = raw_text
+    # El modelo ya no repite el texto OCR (solo ve un extracto): devolver el original
+    data["raw_text"] = raw_text
 
     return data
 
 
-def refinar_datos_factura(raw_text: str, data_inicial: Dict[str, Any]) -> Dict[str, Any]:
+def extraer_datos_con_ia(raw_text: str, historial_usuario: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
     """
-    Envía el texto OCR completo y los datos iniciales al modelo para que devuelva
-    un JSON bien estructurado con los campos de la factura refinados.
+    Extrae TODOS los datos de la factura directamente del texto OCR usando el modelo.
+    Esta es la función principal que debe usarse para determinar los campos.
     """
+    content = _chat(_extraction_messages(raw_text, historial_usuario), temperature=0.1, max_tokens=1000)
+    return _parse_extraction(content, raw_text)
+
+
+async def extraer_datos_con_ia_async(
+    raw_text: str, historial_usuario: Optional[List[Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    """Versión asíncrona de extraer_datos_con_ia"""
+    content = await _achat(_extraction_messages(raw_text, historial_usuario), temperature=0.1, max_tokens=1000)
+    return _parse_extraction(content, raw_text)
+
+
+def _refine_messages(raw_text: str, data_inicial: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Mensajes para corregir y completar una extracción inicial"""
     system_prompt = (
         "Eres un asistente experto en facturas. "
         "Recibirás el texto OCR completo de una factura y un JSON con una extracción inicial. "
@@ -161,51 +679,39 @@ def refinar_datos_factura(raw_text: str, data_inicial: Dict[str, Any]) -> Dict[s
         "Responde ÚNICAMENTE con un JSON válido, sin texto adicional."
     )
 
-    user_prompt = (
-        "Texto OCR de la factura:\n"
-        "------------------------\n"
-        f"{raw_text}\n\n"
-        "Datos extraídos inicialmente (pueden contener errores o campos vacíos):\n"
-        "---------------------------------------------------------------------\n"
-        f"{json.dumps(data_inicial, ensure_ascii=False, indent=2)}\n\n"
-        "Devuelve un JSON con la siguiente estructura (rellena lo que puedas, deja null si no sabes):\n"
-        "{\n"
-        '  \"invoice_number\": string | null,\n'
-        '  \"date\": string | null,            // formato sugerido YYYY-MM-DD si es posible\n'
-        '  \"supplier\": string | null,\n'
-        '  \"nit\": string | null,\n'
-        '  \"subtotal\": number | null,\n'
-        '  \"tax\": number | null,\n'
-        '  \"total\": number | null,\n'
-        '  \"currency\": string | null,        // por ejemplo \"COP\", \"USD\", etc.\n'
-        '  \"payment_terms\": string | null,   // condiciones de pago si aparecen\n'
-        '  \"raw_text\": string                // incluye aquí el texto OCR completo\n'
-        "}\n"
-        "Recuerda: responde solo con JSON puro, sin comentarios ni texto fuera del JSON."
-    )
+    def user_prompt(texto: str) -> str:
+        return (
+            "Texto OCR de la factura:\n"
+            "------------------------\n"
+            f"{texto}\n\n"
+            "Datos extraídos inicialmente (pueden contener errores o campos vacíos):\n"
+            "---------------------------------------------------------------------\n"
+            f"{_compact_json(data_inicial)}\n\n"
+            "Devuelve un JSON con la siguiente estructura (rellena lo que puedas, deja null si no sabes):\n"
+            "{\n"
+            '  \"invoice_number\": string | null,\n'
+            '  \"date\": string | null,            // formato sugerido YYYY-MM-DD si es posible\n'
+            '  \"supplier\": string | null,\n'
+            '  \"nit\": string | null,\n'
+            '  \"subtotal\": number | null,\n'
+            '  \"tax\": number | null,\n'
+            '  \"total\": number | null,\n'
+            '  \"currency\": string | null,        // por ejemplo \"COP\", \"USD\", etc.\n'
+            '  \"payment_terms\": string | null    // condiciones de pago si aparecen\n'
+            "}\n"
+            "Recuerda: responde solo con JSON puro, sin comentarios ni texto fuera del JSON."
+        )
 
-    content = _chat(
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.1,
-        max_tokens=800,
-    )
+    texto = select_relevant_lines(raw_text, _ocr_budget(system_prompt, user_prompt("")))
 
-    # Intentar parsear como JSON robustamente
-    content_stripped = content.strip()
-    # Por si el modelo rodea el JSON con texto, buscar el primer '{' y el último '}'
-    if not content_stripped.startswith("{"):
-        start = content_stripped.find("{")
-        end = content_stripped.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            content_stripped = content_stripped[start : end + 1]
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt(texto)},
+    ]
 
-    try:
-        data = json.loads(content_stripped)
-    except json.JSONDecodeError as e:
-        raise LocalAIAgentError(f"No se pudo parsear la respuesta como JSON: {e}\nRespuesta: {content}")
+
+def _parse_refined(content: str, raw_text: str) -> Dict[str, Any]:
+    data = _parse_json_content(content)
 
     # Asegurar que al menos devolvemos los campos esperados
     result: Dict[str, Optional[Any]] = {
@@ -218,22 +724,34 @@ def refinar_datos_factura(raw_text: str, data_inicial: Dict[str, Any]) -> Dict[s
         "total": data.get("total"),
         "currency": data.get("currency"),
         "payment_terms": data.get("payment_terms"),
-        "raw_text": data.get("raw_text", raw_text),
+        "raw_text": raw_text,
     }
 
     return result
 
 
-def responder_pregunta_sobre_factura(
+def refinar_datos_factura(raw_text: str, data_inicial: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Envía el texto OCR completo y los datos iniciales al modelo para que devuelva
+    un JSON bien estructurado con los campos de la factura refinados.
+    """
+    content = _chat(_refine_messages(raw_text, data_inicial), temperature=0.1, max_tokens=800)
+    return _parse_refined(content, raw_text)
+
+
+async def refinar_datos_factura_async(raw_text: str, data_inicial: Dict[str, Any]) -> Dict[str, Any]:
+    """Versión asíncrona de refinar_datos_factura"""
+    content = await _achat(_refine_messages(raw_text, data_inicial), temperature=0.1, max_tokens=800)
+    return _parse_refined(content, raw_text)
+
+
+def _question_messages(
     raw_text: str,
     data_estructurada: Dict[str, Any],
     pregunta: str,
     historial_usuario: Optional[List[Dict[str, Any]]] = None,
-) -> str:
-    """
-    Permite hacer preguntas en lenguaje natural sobre una factura concreta.
-    Usa como contexto el texto OCR completo y los datos ya estructurados.
-    """
+) -> List[Dict[str, str]]:
+    """Mensajes para responder una pregunta sobre la factura o el historial"""
     system_prompt = (
         "Eres un asistente que responde preguntas sobre facturas usando ÚNICAMENTE "
         "la información proporcionada (texto OCR, datos estructurados y/o historial de facturas del usuario). "
@@ -244,66 +762,112 @@ def responder_pregunta_sobre_factura(
     )
 
     # Añadir contexto histórico si está disponible
-    contexto_historico = ""
-    if historial_usuario and len(historial_usuario) > 0:
-        contexto_historico = (
+    contexto_historico = _history_context(
+        historial_usuario,
+        limit=2,
+        header=(
             "\n\nCONTEXTO: Facturas anteriores del mismo usuario:\n"
             "==================================================\n"
-        )
-        for i, fact in enumerate(historial_usuario[:2], 1):
-            contexto_historico += (
-                f"\nFactura anterior {i}:\n"
-                f"- Número: {fact.get('invoice_number', 'N/A')}\n"
-                f"- Emisor: {fact.get('supplier', 'N/A')}\n"
-                f"- Fecha: {fact.get('date', 'N/A')}\n"
-            )
-            if fact.get('data'):
-                contexto_historico += f"- Datos: {json.dumps(fact['data'], ensure_ascii=False, indent=2)}\n"
-        contexto_historico += (
+        ),
+        label="Factura anterior",
+        data_label="Datos",
+        footer=(
             "\nUsa este contexto para dar respuestas más precisas y consistentes "
             "con el historial del usuario.\n"
-        )
+        ),
+        max_tokens=int(PROMPT_TOKEN_BUDGET * HISTORY_TOKEN_SHARE),
+    )
 
     # Construir contexto según lo que tengamos disponible
-    if raw_text and data_estructurada:
-        context = (
-            "Datos estructurados de la factura actual:\n"
-            f"{json.dumps(data_estructurada, ensure_ascii=False, indent=2)}\n\n"
-            "Texto OCR completo de la factura actual:\n"
-            f"{raw_text}\n"
-            f"{contexto_historico}"
-        )
-    elif historial_usuario and len(historial_usuario) > 0:
-        # Si no hay factura actual, usar el historial
-        context = (
-            "El usuario está preguntando sobre sus facturas anteriores.\n"
-            f"{contexto_historico}\n\n"
-            "Usa esta información para responder la pregunta del usuario sobre sus facturas procesadas anteriormente."
-        )
-    else:
-        context = (
+    def context(texto: str) -> str:
+        if raw_text and data_estructurada:
+            return (
+                "Datos estructurados de la factura actual:\n"
+                f"{_compact_json(data_estructurada)}\n\n"
+                "Texto OCR completo de la factura actual:\n"
+                f"{texto}\n"
+                f"{contexto_historico}"
+            )
+        elif historial_usuario and len(historial_usuario) > 0:
+            # Si no hay factura actual, usar el historial
+            return (
+                "El usuario está preguntando sobre sus facturas anteriores.\n"
+                f"{contexto_historico}\n\n"
+                "Usa esta información para responder la pregunta del usuario sobre sus facturas procesadas anteriormente."
+            )
+        return (
             "Datos disponibles:\n"
-            f"{json.dumps(data_estructurada, ensure_ascii=False, indent=2)}\n"
-            f"{raw_text if raw_text else 'Sin texto OCR disponible'}\n"
+            f"{_compact_json(data_estructurada)}\n"
+            f"{texto if texto else 'Sin texto OCR disponible'}\n"
         )
 
-    user_prompt = (
-        "Contexto de la factura:\n"
-        "-----------------------\n"
-        f"{context}\n\n"
-        f"Pregunta del usuario: {pregunta}\n\n"
-        "Responde de forma clara y breve."
-    )
+    def user_prompt(texto: str) -> str:
+        return (
+            "Contexto de la factura:\n"
+            "-----------------------\n"
+            f"{context(texto)}\n\n"
+            f"Pregunta del usuario: {pregunta}\n\n"
+            "Responde de forma clara y breve."
+        )
+
+    # Las palabras de la pregunta también cuentan para elegir las líneas del OCR
+    terms = {word.strip("¿?¡!.,:;()[]\"'") for word in pregunta.lower().split()}
+    terms = {term for term in terms if len(term) >= 4}
+    texto = select_relevant_lines(raw_text or "", _ocr_budget(system_prompt, user_prompt("")), terms)
 
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt(texto)},
+    ]
+
+
+def responder_pregunta_sobre_factura(
+    raw_text: str,
+    data_estructurada: Dict[str, Any],
+    pregunta: str,
+    historial_usuario: Optional[List[Dict[str, Any]]] = None,
+) -> str:
+    """
+    Permite hacer preguntas en lenguaje natural sobre una factura concreta.
+    Usa como contexto el texto OCR completo y los datos ya estructurados.
+    """
     answer = _chat(
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
+        _question_messages(raw_text, data_estructurada, pregunta, historial_usuario),
         temperature=0.2,
         max_tokens=512,
     )
+    return answer.strip()
+
 
+async def responder_pregunta_sobre_factura_async(
+    raw_text: str,
+    data_estructurada: Dict[str, Any],
+    pregunta: str,
+    historial_usuario: Optional[List[Dict[str, Any]]] = None,
+) -> str:
+    """Versión asíncrona de responder_pregunta_sobre_factura"""
+    answer = await _achat(
+        _question_messages(raw_text, data_estructurada, pregunta, historial_usuario),
+        temperature=0.2,
+        max_tokens=512,
+    )
     return answer.strip()
 
 
+async def responder_pregunta_sobre_factura_stream(
+    raw_text: str,
+    data_estructurada: Dict[str, Any],
+    pregunta: str,
+    historial_usuario: Optional[List[Dict[str, Any]]] = None,
+) -> AsyncIterator[str]:
+    """Versión en streaming de responder_pregunta_sobre_factura: devuelve fragmentos de la respuesta"""
+    stream = _achat_stream(
+        _question_messages(raw_text, data_estructurada, pregunta, historial_usuario),
+        temperature=0.2,
+        max_tokens=512,
+    )
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
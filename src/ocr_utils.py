@@ -1,90 +1,737 @@
 from PIL import Image
+import numpy as np
 import pytesseract
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from functools import lru_cache
+import hashlib
+import json
 import os
+import sqlite3
+import subprocess
 import tempfile
+import threading
+import time
 
-def images_from_file(path):
+try:
+    import tesserocr  # Backend opcional: Tesseract en proceso vía su API C
+except ImportError:
+    tesserocr = None
+
+# Paralelismo del OCR por página. Cada llamada a Tesseract es un subproceso
+# independiente, así que un pool de hilos basta para ocupar todos los núcleos;
+# "process" usa un pool de procesos (útil con backends que retienen el GIL).
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_EXECUTOR = os.getenv("OCR_EXECUTOR", "thread")  # "thread" | "process"
+
+# Motor OCR: "pytesseract" lanza un proceso tesseract por página; "tesserocr"
+# mantiene el motor cargado en memoria (uno por hilo/proceso trabajador y por
+# idioma), evitando recargar los traineddata en cada página.
+OCR_BACKEND = os.getenv("OCR_BACKEND", "pytesseract")
+TESSDATA_PATH = os.getenv("TESSDATA_PATH")  # carpeta tessdata para tesserocr (opcional)
+
+# Páginas PDF con al menos este número de caracteres en su capa de texto se
+# toman tal cual, sin rasterizar ni pasar por Tesseract
+PDF_TEXT_LAYER = os.getenv("PDF_TEXT_LAYER", "1") != "0"
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "25"))
+
+# Preprocesado de imagen antes del OCR (opcional, desactivado por defecto para
+# no cambiar el texto que devuelve Tesseract). OCR_PREPROCESS lista las etapas
+# activas por defecto, separadas por comas (p. ej. "grayscale,downscale"); cada
+# llamada puede sobrescribirlas con el parámetro `preprocess`.
+PREPROCESS_STAGES = ("grayscale", "downscale", "deskew", "binarize")
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "")
+PREPROCESS_RECOMMENDED = "grayscale,downscale"
+PREPROCESS_DEFAULTS = {
+    "target_dpi": int(os.getenv("OCR_TARGET_DPI", "300")),  # DPI máximo útil para Tesseract
+    "target_x_height": int(os.getenv("OCR_TARGET_X_HEIGHT", "32")),  # altura x objetivo (px)
+    "max_pixels": int(os.getenv("OCR_MAX_PIXELS", "12000000")),  # tope absoluto de píxeles
+    "max_skew": 5.0,  # ángulo máximo (grados) que busca el enderezado
+}
+
+# Registrar en consola la duración de cada etapa (preprocesado y OCR) por archivo
+OCR_LOG = os.getenv("OCR_LOG", "1") != "0"
+
+# Resolución con la que se rasterizan las páginas PDF (valor por defecto de pdf2image)
+PDF_DPI = int(os.getenv("PDF_DPI", "200"))
+
+# Caché persistente de resultados OCR por página, indexada por el SHA-256 del
+# archivo y la configuración del motor. Se expulsan las páginas menos usadas
+# cuando el tamaño total supera OCR_CACHE_MAX_MB.
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE", "1") != "0"
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", os.path.join("data", "ocr_cache.sqlite3"))
+OCR_CACHE_MAX_BYTES = int(float(os.getenv("OCR_CACHE_MAX_MB", "256")) * 1024 * 1024)
+
+
+class OCRCache:
     """
-    Convierte un archivo (PDF o imagen) a lista de imágenes PIL
+    Caché en disco (SQLite) de texto OCR por página con expulsión LRU acotada
+    por tamaño. Segura para usar desde varios hilos y procesos.
+    """
+
+    def __init__(self, path=OCR_CACHE_PATH, max_bytes=OCR_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            with self._lock:
+                conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS documents (
+                        doc_key TEXT PRIMARY KEY,
+                        page_count INTEGER NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS pages (
+                        doc_key TEXT NOT NULL,
+                        page INTEGER NOT NULL,
+                        text TEXT NOT NULL,
+                        source TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        last_used REAL NOT NULL,
+                        PRIMARY KEY (doc_key, page)
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_pages_last_used ON pages(last_used);
+                    """
+                )
+                self._initialized = True
+        return conn
+
+    def get(self, doc_key):
+        """
+        Devuelve (page_count, {page: resultado}) o (None, {}) si el documento
+        no está en caché. Marca las páginas encontradas como usadas.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT page_count FROM documents WHERE doc_key = ?", (doc_key,)
+            ).fetchone()
+            if row is None:
+                return None, {}
+            pages = {
+                page: {"page": page, "text": text, "source": source}
+                for page, text, source in conn.execute(
+                    "SELECT page, text, source FROM pages WHERE doc_key = ?", (doc_key,)
+                )
+            }
+            if pages:
+                with conn:
+                    conn.execute(
+                        "UPDATE pages SET last_used = ? WHERE doc_key = ?",
+                        (time.time(), doc_key),
+                    )
+            return row[0], pages
+        finally:
+            conn.close()
+
+    def put(self, doc_key, page_count, results):
+        """Guarda los resultados por página de un documento y aplica la expulsión LRU"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO documents (doc_key, page_count) VALUES (?, ?)",
+                    (doc_key, page_count),
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO pages (doc_key, page, text, source, size, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (doc_key, r["page"], r["text"], r["source"], len(r["text"].encode("utf-8")), now)
+                        for r in results
+                    ],
+                )
+            self._evict(conn)
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_delete = []
+        for doc_key, page, size in conn.execute(
+            "SELECT doc_key, page, size FROM pages ORDER BY last_used ASC"
+        ):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((doc_key, page))
+            total -= size
+        with conn:
+            conn.executemany("DELETE FROM pages WHERE doc_key = ? AND page = ?", to_delete)
+            conn.execute(
+                "DELETE FROM documents WHERE doc_key NOT IN (SELECT DISTINCT doc_key FROM pages)"
+            )
+
+
+_ocr_cache = None
+
+
+def get_ocr_cache():
+    """Devuelve la caché OCR compartida del proceso (se crea al primer uso)"""
+    global _ocr_cache
+    if _ocr_cache is None:
+        os.makedirs(os.path.dirname(OCR_CACHE_PATH) or ".", exist_ok=True)
+        _ocr_cache = OCRCache()
+    return _ocr_cache
+
+
+@lru_cache(maxsize=None)
+def _tesseract_version(backend):
+    try:
+        if backend == "tesserocr" and tesserocr is not None:
+            return tesserocr.tesseract_version().splitlines()[0]
+        return str(pytesseract.get_tesseract_version())
+    except (Exception, SystemExit):  # pytesseract sale con SystemExit ante versiones raras
+        return "unknown"
+
+
+def file_sha256(path):
+    """SHA-256 del contenido de un archivo, leído por bloques"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ocr_cache_key(path, **settings):
+    """
+    Clave de caché: hash del archivo + versión de Tesseract + cualquier ajuste
+    que cambie el texto resultante (idioma, DPI, capa de texto...)
+    """
+    settings["tesseract"] = _tesseract_version(settings.get("backend"))
+    settings["text_layer_min_chars"] = TEXT_LAYER_MIN_CHARS
+    fingerprint = json.dumps(settings, sort_keys=True)
+    return f"{file_sha256(path)}:{hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()[:16]}"
+
+
+# Firmas (magic bytes) de los formatos que acepta el OCR -> extensión
+FILE_SIGNATURES = (
+    (b'%PDF', '.pdf'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'II*\x00', '.tif'),
+    (b'MM\x00*', '.tif'),
+    (b'BM', '.bmp'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+)
+
+
+def sniff_suffix(head):
+    """
+    Extensión que corresponde a los primeros bytes de un archivo (p. ej. el
+    primer bloque de una subida), o None si no es un formato reconocido
+    """
+    for signature, suffix in FILE_SIGNATURES:
+        if head.startswith(signature):
+            return suffix
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
+
+def is_pdf_file(path):
+    """
+    Indica si un archivo es PDF, por extensión o por la firma %PDF
     """
-    ext = os.path.splitext(path)[1].lower()
-    
-    # Intentar detectar si es PDF
-    is_pdf = False
-    
     # Método 1: Por extensión
-    if ext in ('.pdf',):
-        is_pdf = True
-    
+    if os.path.splitext(path)[1].lower() == '.pdf':
+        return True
+
     # Método 2: Leer primeros bytes (más robusto)
-    if not is_pdf:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(5).startswith(b'%PDF')
+    except:
+        return False
+
+
+def _find_poppler_path():
+    """
+    Busca poppler en rutas comunes de Windows; None si debe usarse el PATH
+    """
+    possible_paths = [
+        r"C:\Program Files\poppler\Library\bin",
+        r"C:\Program Files (x86)\poppler\Library\bin",
+        r"C:\poppler\Library\bin",
+        r"C:\Program Files\poppler-23.11.0\Library\bin",
+        r"C:\Program Files\poppler-24.08.0\Library\bin",
+        r"C:\Users\User\Downloads\poppler-25.11.0\Library\bin",
+        # Agregar más rutas si es necesario
+    ]
+
+    for p in possible_paths:
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def pdf_text_layer(path):
+    """
+    Devuelve el texto embebido de cada página de un PDF (lista, una entrada por
+    página) usando pdftotext de poppler, o None si no se pudo leer.
+    """
+    poppler_path = _find_poppler_path()
+    cmd = os.path.join(poppler_path, "pdftotext") if poppler_path else "pdftotext"
+    try:
+        result = subprocess.run(
+            [cmd, "-layout", "-enc", "UTF-8", path, "-"],
+            capture_output=True,
+            check=True,
+            timeout=60,
+        )
+    except Exception as e:
+        print(f"⚠️ No se pudo leer la capa de texto del PDF: {e}")
+        return None
+
+    # pdftotext termina cada página con un salto de página (\f)
+    pages = result.stdout.decode("utf-8", errors="replace").split("\f")
+    return pages[:-1] if len(pages) > 1 else pages
+
+
+def iter_images_from_file(path, dpi=None, pages=None):
+    """
+    Genera las páginas de un archivo (PDF o imagen) como imágenes PIL, una a una.
+
+    Los PDF se rasterizan página por página (first_page/last_page), de modo que
+    en memoria solo vive la página que se está consumiendo. `pages` limita la
+    rasterización a esos números de página (1-based).
+    """
+    if not is_pdf_file(path):
+        # Intentar abrir como imagen
         try:
-            with open(path, 'rb') as f:
-                header = f.read(5)
-                if header.startswith(b'%PDF'):
-                    is_pdf = True
-        except:
-            pass
-    
-    # Procesar según tipo
-    if is_pdf:
+            image = Image.open(path)
+        except Exception as e:
+            raise Exception(f"No se pudo abrir el archivo como imagen o PDF. Error: {e}")
+        yield image
+        return
+
+    dpi = dpi or PDF_DPI
+    try:
+        # Intentar encontrar poppler automáticamente (si no, se usa el PATH)
+        poppler_path = _find_poppler_path()
+        page_count = pdfinfo_from_path(path, poppler_path=poppler_path)["Pages"]
+    except Exception as e:
+        print(f"Error al convertir PDF: {e}")
+        raise Exception(f"No se pudo procesar el PDF. ¿Está poppler instalado? Error: {e}")
+
+    for page in pages if pages is not None else range(1, page_count + 1):
         try:
-            # Intentar encontrar poppler automáticamente
-            poppler_path = None
-            
-            # Rutas comunes de poppler en Windows
-            possible_paths = [
-                r"C:\Program Files\poppler\Library\bin",
-                r"C:\Program Files (x86)\poppler\Library\bin",
-                r"C:\poppler\Library\bin",
-                r"C:\Program Files\poppler-23.11.0\Library\bin",
-                r"C:\Program Files\poppler-24.08.0\Library\bin",
-                r"C:\Users\User\Downloads\poppler-25.11.0\Library\bin",
-                # Agregar más rutas si es necesario
-            ]
-            
-            for p in possible_paths:
-                if os.path.exists(p):
-                    poppler_path = p
-                    break
-            
-            # Convertir PDF a imágenes (requiere poppler)
-            if poppler_path:
-                images = convert_from_path(path, poppler_path=poppler_path)
-            else:
-                # Intentar sin especificar ruta (por si está en PATH)
-                images = convert_from_path(path)
-            
-            return images
+            # Convertir una sola página a imagen (requiere poppler)
+            images = convert_from_path(
+                path,
+                dpi=dpi,
+                first_page=page,
+                last_page=page,
+                poppler_path=poppler_path,
+            )
         except Exception as e:
             print(f"Error al convertir PDF: {e}")
             raise Exception(f"No se pudo procesar el PDF. ¿Está poppler instalado? Error: {e}")
+        for image in images:
+            yield image
+
+
+def images_from_file(path, dpi=None):
+    """
+    Convierte un archivo (PDF o imagen) a lista de imágenes PIL
+    """
+    return list(iter_images_from_file(path, dpi=dpi))
+
+def _otsu_threshold(gray):
+    """Umbral de Otsu sobre un array uint8, calculado con el histograma"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    mass_bg = np.cumsum(hist * levels)
+    mean_bg = mass_bg / np.maximum(weight_bg, 1)
+    mean_fg = (mass_bg[-1] - mass_bg) / np.maximum(weight_fg, 1)
+    between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between))
+
+
+def _estimate_text_height(ink):
+    """
+    Estima la altura x del texto (px) a partir de los tramos verticales de
+    tinta (percentil 95, cercano a la altura de las minúsculas), calculada
+    sobre la imagen submuestreada 2x.
+    """
+    sample = ink[::2, ::2]
+    padded = np.zeros((sample.shape[0] + 2, sample.shape[1]), dtype=np.int8)
+    padded[1:-1] = sample
+    edges = np.diff(padded, axis=0).T  # columna a columna
+    starts = np.nonzero(edges == 1)[1]
+    ends = np.nonzero(edges == -1)[1]
+    runs = ends - starts
+    runs = runs[(runs >= 2) & (runs < sample.shape[0] // 10)]
+    if runs.size < 50:
+        return None
+    return float(np.percentile(runs, 95)) * 2
+
+
+def _estimate_skew(ink, max_skew, step=0.25):
+    """
+    Ángulo de inclinación (grados) que maximiza la nitidez del perfil de
+    proyección horizontal. En vez de rotar la imagen para cada ángulo se
+    cizallan las coordenadas de los píxeles de tinta.
+    """
+    stride = max(1, max(ink.shape) // 1000)
+    ys, xs = np.nonzero(ink[::stride, ::stride])
+    if ys.size < 100:
+        return 0.0
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_skew, max_skew + step / 2, step):
+        rows = np.rint(ys - xs * np.tan(np.radians(angle))).astype(np.int64)
+        hist = np.bincount(rows - rows.min()).astype(np.float64)
+        score = float(np.dot(hist, hist))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def resolve_preprocess(preprocess=None):
+    """
+    Normaliza la configuración de preprocesado: None usa OCR_PREPROCESS, True
+    usa OCR_PREPROCESS o, si está vacío, PREPROCESS_RECOMMENDED, False la
+    desactiva, una lista/cadena indica las etapas y un dict permite además
+    ajustar parámetros ({"stages": [...], "target_dpi": 200, ...}).
+    """
+    def parse(stages):
+        if isinstance(stages, str):
+            return [] if stages.strip().lower() in ("", "0", "none") else stages.split(",")
+        return list(stages or [])
+
+    options = dict(PREPROCESS_DEFAULTS)
+    if preprocess is None:
+        stages = parse(OCR_PREPROCESS)
+    elif preprocess is True:
+        stages = parse(OCR_PREPROCESS) or parse(PREPROCESS_RECOMMENDED)
+    elif isinstance(preprocess, dict):
+        options.update(preprocess)
+        stages = parse(options.pop("stages", OCR_PREPROCESS))
     else:
-        # Intentar abrir como imagen
-        try:
-            return [Image.open(path)]
-        except Exception as e:
-            raise Exception(f"No se pudo abrir el archivo como imagen o PDF. Error: {e}")
+        stages = parse(preprocess)
+    stages = [s.strip() for s in stages if s.strip()]
+    unknown = set(stages) - set(PREPROCESS_STAGES)
+    if unknown:
+        raise ValueError(f"Etapas de preprocesado desconocidas: {', '.join(sorted(unknown))}")
+    # Las etapas se aplican siempre en el orden canónico
+    options["stages"] = [s for s in PREPROCESS_STAGES if s in stages]
+    return options
 
-def ocr_image(pil_image, lang='spa+eng'):
+
+def preprocess_image(pil_image, preprocess=None):
     """
-    Extrae texto de una imagen PIL usando Tesseract
+    Prepara una imagen para el OCR: escala de grises, reducción adaptativa
+    (según DPI, altura del texto y tope de píxeles), enderezado y binarización.
+
+    Devuelve (imagen, tiempos) con la duración en segundos de cada etapa.
+    """
+    options = resolve_preprocess(preprocess)
+    stages = options["stages"]
+    timings = {}
+    if not stages:
+        return pil_image, timings
+
+    image = pil_image
+    start = time.perf_counter()
+    gray = np.asarray(image.convert("L"))
+    timings["grayscale"] = time.perf_counter() - start
+
+    ink = None
+    if "downscale" in stages:
+        start = time.perf_counter()
+        threshold = _otsu_threshold(gray)
+        ink = gray < threshold
+        scale = 1.0
+        dpi = image.info.get("dpi")
+        if dpi and dpi[0] and dpi[0] > options["target_dpi"]:
+            scale = min(scale, options["target_dpi"] / float(dpi[0]))
+        text_height = _estimate_text_height(ink)
+        if text_height and text_height > options["target_x_height"]:
+            scale = min(scale, options["target_x_height"] / text_height)
+        pixels = gray.shape[0] * gray.shape[1]
+        if pixels > options["max_pixels"]:
+            scale = min(scale, (options["max_pixels"] / pixels) ** 0.5)
+        if scale < 0.95:
+            size = (max(1, int(gray.shape[1] * scale)), max(1, int(gray.shape[0] * scale)))
+            gray = np.asarray(
+                Image.fromarray(gray).resize(size, Image.BILINEAR, reducing_gap=2.0)
+            )
+            ink = None
+        timings["downscale"] = time.perf_counter() - start
+
+    if "deskew" in stages:
+        start = time.perf_counter()
+        if ink is None:
+            ink = gray < _otsu_threshold(gray)
+        angle = _estimate_skew(ink, options["max_skew"])
+        if abs(angle) >= 0.25:
+            gray = np.asarray(
+                Image.fromarray(gray).rotate(
+                    angle, resample=Image.BILINEAR, expand=True, fillcolor=255
+                )
+            )
+        timings["deskew"] = time.perf_counter() - start
+
+    if "binarize" in stages:
+        start = time.perf_counter()
+        gray = np.where(gray >= _otsu_threshold(gray), 255, 0).astype(np.uint8)
+        timings["binarize"] = time.perf_counter() - start
+
+    return Image.fromarray(gray), timings
+
+
+_tesserocr_local = threading.local()
+
+
+def _tesserocr_api(lang):
+    """
+    Devuelve la instancia PyTessBaseAPI de este hilo para `lang`, creándola
+    (y cargando los modelos de idioma) solo la primera vez.
     """
+    if tesserocr is None:
+        raise Exception("El backend 'tesserocr' requiere instalar tesserocr (pip install tesserocr)")
+    apis = getattr(_tesserocr_local, "apis", None)
+    if apis is None:
+        apis = _tesserocr_local.apis = {}
+    api = apis.get(lang)
+    if api is None:
+        if TESSDATA_PATH:
+            api = tesserocr.PyTessBaseAPI(path=TESSDATA_PATH, lang=lang)
+        else:
+            api = tesserocr.PyTessBaseAPI(lang=lang)
+        apis[lang] = api
+    return api
+
+
+def _ocr_page(pil_image, lang='spa+eng', backend=None, preprocess=None):
+    """
+    Preprocesa y aplica OCR a una página. Devuelve (texto, tiempos por etapa)
+    """
+    pil_image, timings = preprocess_image(pil_image, preprocess)
+    backend = backend or OCR_BACKEND
+    start = time.perf_counter()
     try:
-        text = pytesseract.image_to_string(pil_image, lang=lang)
-        return text
+        if backend == "tesserocr":
+            api = _tesserocr_api(lang)
+            api.SetImage(pil_image)
+            text = api.GetUTF8Text()
+        else:
+            text = pytesseract.image_to_string(pil_image, lang=lang)
     except Exception as e:
         raise Exception(f"Error en OCR. ¿Está Tesseract instalado? Error: {e}")
+    timings["ocr"] = time.perf_counter() - start
+    return text, timings
+
 
-def ocr_file(path):
+def ocr_image(pil_image, lang='spa+eng', backend=None, preprocess=None):
+    """
+    Extrae texto de una imagen PIL usando Tesseract
+    """
+    return _ocr_page(pil_image, lang, backend, preprocess)[0]
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(executor, workers):
+    """
+    Devuelve un pool persistente por tipo y tamaño. Reutilizar los mismos
+    trabajadores entre llamadas permite que cada uno conserve su motor OCR.
+    """
+    key = (executor, workers)
+    with _executors_lock:
+        pool = _executors.get(key)
+        if pool is None:
+            pool_cls = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+            pool = _executors[key] = pool_cls(max_workers=workers)
+        return pool
+
+
+def _ocr_pages(images, lang, workers, executor, backend, preprocess):
+    """
+    Aplica OCR a un iterable de imágenes y devuelve (texto, tiempos) por
+    página, en orden de página.
+
+    Las páginas se envían al pool a medida que se generan, con como máximo
+    `workers` + 1 páginas en vuelo (una de lectura anticipada): aunque todos
+    los trabajadores estén ocupados, la rasterización de la página siguiente
+    se solapa con su OCR (también con workers=1) y la memoria queda acotada a
+    unas pocas páginas.
+    """
+    workers = max(1, workers)
+    pool = _get_executor(executor, workers)
+    texts = []
+    pending = deque()
+    try:
+        for img in images:
+            pending.append(pool.submit(_ocr_page, img, lang, backend, preprocess))
+            # Soltar nuestra referencia: la imagen vive solo mientras se procesa
+            del img
+            if len(pending) > workers:
+                texts.append(pending.popleft().result())
+        while pending:
+            texts.append(pending.popleft().result())
+    finally:
+        for future in pending:
+            future.cancel()
+    return texts
+
+
+def _extract_pages(path, lang, workers, executor, backend, preprocess, dpi, use_text_layer,
+                   pages=None):
+    """
+    Extrae el texto de las páginas indicadas (todas si pages es None), leyendo
+    la capa de texto de los PDF cuando existe y aplicando OCR al resto.
+    """
+    wanted = set(pages) if pages is not None else None
+    results = []
+    scanned_pages = pages  # None = rasterizar todas las páginas
+    if use_text_layer and is_pdf_file(path):
+        layer = pdf_text_layer(path)
+        if layer is not None:
+            scanned_pages = []
+            for page, text in enumerate(layer, 1):
+                if wanted is not None and page not in wanted:
+                    continue
+                if len(text.strip()) >= TEXT_LAYER_MIN_CHARS:
+                    results.append({"page": page, "text": text, "source": "text_layer"})
+                else:
+                    scanned_pages.append(page)
+
+    if scanned_pages is None or scanned_pages:
+        pages_ocr = _ocr_pages(
+            iter_images_from_file(path, dpi=dpi, pages=scanned_pages),
+            lang,
+            OCR_WORKERS if workers is None else workers,
+            executor or OCR_EXECUTOR,
+            backend,
+            preprocess,
+        )
+        page_numbers = scanned_pages or range(1, len(pages_ocr) + 1)
+        results.extend(
+            {"page": page, "text": text, "source": "ocr", "timings": timings}
+            for page, (text, timings) in zip(page_numbers, pages_ocr)
+        )
+    return results
+
+
+def stage_timings(pages):
+    """Suma por etapa (preprocesado y "ocr") los tiempos de las páginas OCR"""
+    totals = {}
+    for page in pages:
+        for stage, seconds in (page.get("timings") or {}).items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+    return totals
+
+
+def _log_pages(path, results, cached_count):
+    if not OCR_LOG:
+        return
+    ocr_count = sum(1 for r in results if r["source"] == "ocr")
+    parts = [f"{ocr_count} OCR", f"{len(results) - ocr_count} capa de texto"]
+    if cached_count:
+        parts.append(f"{cached_count} de caché")
+    etapas = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in stage_timings(results).items())
+    print(f"🔎 OCR {os.path.basename(path)}: {', '.join(parts)}" + (f" | {etapas}" if etapas else ""))
+
+
+def ocr_pages(path, lang='spa+eng', workers=None, executor=None, dpi=None,
+              use_text_layer=None, use_cache=None, backend=None, preprocess=None):
+    """
+    Extrae el texto de cada página de un archivo (PDF o imagen).
+
+    Devuelve una lista ordenada de dicts {"page", "text", "source"}, donde
+    source es "text_layer" si la página traía texto embebido y se leyó
+    directamente, u "ocr" si se rasterizó y pasó por Tesseract (con el motor
+    `backend`, por defecto OCR_BACKEND). Las páginas OCR incluyen "timings"
+    con la duración de cada etapa de preprocesado (ver preprocess_image) y del
+    OCR; con OCR_LOG se registra además el total por etapa del archivo.
+
+    Con la caché activa (OCR_CACHE / use_cache) un archivo ya procesado con la
+    misma configuración se devuelve sin llamar a Tesseract; si solo faltan
+    algunas páginas (expulsadas de la caché) se procesan únicamente esas.
+    """
+    if use_text_layer is None:
+        use_text_layer = PDF_TEXT_LAYER
+    if use_cache is None:
+        use_cache = OCR_CACHE_ENABLED
+    backend = backend or OCR_BACKEND
+    preprocess = resolve_preprocess(preprocess)
+    dpi = dpi or PDF_DPI
+
+    cache = None
+    cached = {}
+    page_count = None
+    if use_cache:
+        try:
+            cache = get_ocr_cache()
+            cache_key = ocr_cache_key(
+                path, lang=lang, dpi=dpi, text_layer=use_text_layer, backend=backend,
+                preprocess=preprocess,
+            )
+            page_count, cached = cache.get(cache_key)
+        except Exception as e:
+            print(f"⚠️ Caché OCR no disponible: {e}")
+            cache = None
+
+    if page_count is not None:
+        missing = [p for p in range(1, page_count + 1) if p not in cached]
+        if not missing:
+            _log_pages(path, [], len(cached))
+            return [cached[p] for p in sorted(cached)]
+    else:
+        missing = None
+
+    results = _extract_pages(
+        path, lang, workers, executor, backend, preprocess, dpi, use_text_layer, pages=missing
+    )
+    _log_pages(path, results, len(cached))
+
+    if cache is not None:
+        try:
+            cache.put(cache_key, page_count or len(results), results)
+        except Exception as e:
+            print(f"⚠️ No se pudo guardar en caché OCR: {e}")
+
+    results.extend(cached.values())
+    results.sort(key=lambda r: r["page"])
+    return results
+
+
+def ocr_file(path, lang='spa+eng', workers=None, executor=None, dpi=None,
+             use_text_layer=None, use_cache=None, backend=None, preprocess=None):
     """
     Extrae texto de un archivo (PDF o imagen)
+
+    Las páginas PDF con capa de texto se leen directamente; el resto se
+    rasterizan de una en una y se procesan en paralelo con `workers`
+    hilos/procesos (por defecto OCR_WORKERS y OCR_EXECUTOR).
     """
     try:
-        images = images_from_file(path)
-        texts = [ocr_image(img) for img in images]
-        return "\n\n".join(texts)
+        pages = ocr_pages(
+            path,
+            lang=lang,
+            workers=workers,
+            executor=executor,
+            dpi=dpi,
+            use_text_layer=use_text_layer,
+            use_cache=use_cache,
+            backend=backend,
+            preprocess=preprocess,
+        )
+        return "\n\n".join(p["text"] for p in pages)
     except Exception as e:
-        raise Exception(f"Error procesando archivo: {e}")
\ No newline at end of file
+        raise Exception(f"Error procesando archivo: {e}")
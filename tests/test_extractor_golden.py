@@ -0,0 +1,137 @@
+"""
+Pruebas "golden" del extractor por regex: la salida de InvoiceExtractor sobre
+textos fijos debe coincidir con la de la implementación anterior a la
+precompilación de patrones y el prefiltro de literales (commit 507e522). Se
+comprueba además que el prefiltro nunca descarta un patrón que coincidiría,
+incluidos los casos de plegado de mayúsculas de re.IGNORECASE (ı, ſ, İ, K).
+
+El proveedor se obtiene sin spaCy (heurísticas por líneas) para que el
+resultado no dependa del modelo instalado.
+"""
+import os
+import random
+import sys
+
+os.environ.setdefault("EXTRACTOR_USE_NER", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pytest
+
+from extractor import FIELD_PATTERNS, InvoiceExtractor, _fold
+
+# (texto, salida de extract_all sin raw_text) generada con la versión anterior
+GOLDEN = [
+    ('EMPRESA XYZ S.A.S\nNIT: 900.123.456-7\n\nFACTURA No: FAC-2024-001\nFecha: 15/11/2024\n\nCliente: Juan Pérez\nNIT/CC: 123456789\n\nProducto A      $100,000\nProducto B      $50,000\n\nSubtotal:       $150,000.00\nIVA (19%):      $28,500.00\nTotal:          $178,500.00\n',
+     {'invoice_number': 'FAC-2024-001', 'date': '2024-11-15', 'supplier': 'EMPRESA XYZ S.A.S', 'nit': '900.123.456-7', 'subtotal': '150000.00', 'tax': None, 'total': '150000.00'}),
+    ('Servicios Públicos de Medellín E.S.P.\nFactura de venta N° SP-7788123\nFecha de emisión: 03-02-2023\nNIT 890.904.996-1\nConsumo energía 230 kWh\nSubtotal 95430.50\nIVA 0.00\nTotal a pagar 95430.50\n',
+     {'invoice_number': 'de', 'date': '2023-02-03', 'supplier': 'Servicios Públicos de Medellín E.S.P.', 'nit': '890.904.996-1', 'subtotal': '95430.50', 'tax': '0.00', 'total': '95430.50'}),
+    ('ACME Corporation Ltda\nINVOICE # INV-55821\nDate: 12/31/2023\nTax ID: 12-3456789\nSub-total: 1,250.00\nTax: 100.00\nTOTAL: 1,350.00\n',
+     {'invoice_number': 'INV-55821', 'date': '12/31/2023', 'supplier': 'ACME Corporation Ltda', 'nit': '12-3456789', 'subtotal': '1250.00', 'tax': '100.00', 'total': '1250.00'}),
+    ('Comercializadora Andina CIA\nFact. No. 000123\n5 de marzo de 2024\nRUC: 20123456789\nBase imponible 840.00\nImpuesto 151.20\nImporte total 991.20\n',
+     {'invoice_number': '000123', 'date': '5 de marzo de 2024', 'supplier': 'Comercializadora Andina CIA', 'nit': '20123456789', 'subtotal': '840.00', 'tax': '151.20', 'total': '991.20'}),
+    ('Distribuidora del Norte\nNo. Factura: DN-2024-88\nIdentificación: 79.555.123\nMonto total 45.000,00\n',
+     {'invoice_number': 'DN-2024-88', 'date': None, 'supplier': 'Distribuidora del Norte', 'nit': '79.555.123', 'subtotal': None, 'tax': None, 'total': '45.000'}),
+    ('Tienda La Esquina\nTicket 0045\n12 enero 2025\nTOTAL $ 12.50\n',
+     {'invoice_number': None, 'date': '12 enero 2025', 'supplier': 'Tienda La Esquina', 'nit': None, 'subtotal': None, 'tax': None, 'total': '12.50'}),
+    ('Factura electrónica FE-100234\nf. 01/01/24\nCUIT 30-71234567-9\nSubtotal: 1000.00\nVAT 210.00\nTotal 1210.00\n',
+     {'invoice_number': 'electr', 'date': '2024-01-01', 'supplier': 'Factura electrónica FE-100234', 'nit': '30-71234567-9', 'subtotal': '1000.00', 'tax': '210.00', 'total': '1000.00'}),
+    ('Proveedor Sin Datos\nGracias por su compra\n',
+     {'invoice_number': None, 'date': None, 'supplier': 'Gracias por su compra', 'nit': None, 'subtotal': None, 'tax': None, 'total': None}),
+    ('',
+     {'invoice_number': None, 'date': None, 'supplier': None, 'nit': None, 'subtotal': None, 'tax': None, 'total': None}),
+    ('   \n\n  \n',
+     {'invoice_number': None, 'date': None, 'supplier': None, 'nit': None, 'subtotal': None, 'tax': None, 'total': None}),
+    ('ABC-1234567 pedido\nXY123456\nTotal 99.99\n',
+     {'invoice_number': 'ABC-1234567', 'date': None, 'supplier': 'ABC-1234567 pedido', 'nit': None, 'subtotal': None, 'tax': None, 'total': '99.99'}),
+    ('fact: 778899\nFACTURA 112233\nsubtotal 10.00 subtotal 20.00\ntotal 30.00 total 40.00\n',
+     {'invoice_number': '778899', 'date': None, 'supplier': 'fact: 778899', 'nit': None, 'subtotal': '10.00', 'tax': None, 'total': '10.00'}),
+    ('Cliente: Juan\nidentificación 1.234.567.890\nNIT 900123456-1\n',
+     {'invoice_number': None, 'date': None, 'supplier': 'Cliente: Juan', 'nit': '900123456-1', 'subtotal': None, 'tax': None, 'total': None}),
+    ('FACTURA Nº İNV-77\nFECHA: 01/02/2024\nNİT: 800.100.200\nTOTAL: 500.00\n',
+     {'invoice_number': 'İNV-77', 'date': '2024-02-01', 'supplier': 'FACTURA Nº İNV-77', 'nit': '800.100.200', 'subtotal': None, 'tax': None, 'total': '500.00'}),
+    ('ınvoice # ZZ-900\nTax ıd: 123.456.789\nsubtotal 10.00\nTotal 11.90\n',
+     {'invoice_number': 'ZZ-900', 'date': None, 'supplier': 'ınvoice # ZZ-900', 'nit': '123.456.789', 'subtotal': '10.00', 'tax': None, 'total': '10.00'}),
+    ('Factura 55\nſubtotal: 200.00\nIVA 38.00\nTotal 238.00\n',
+     {'invoice_number': '55', 'date': None, 'supplier': 'Factura 55', 'nit': None, 'subtotal': '200.00', 'tax': '38.00', 'total': '200.00'}),
+    ('SUBTOTAL 1.00\nİVA 0.19\nTOTAL 1.19\n',
+     {'invoice_number': None, 'date': None, 'supplier': 'SUBTOTAL 1.00', 'nit': None, 'subtotal': '1.00', 'tax': '0.19', 'total': '1.00'}),
+    ('İnvoice A-1\nDATE 10/10/2010\nrfc: 12345678\nſub-total 5.00\n',
+     {'invoice_number': 'A-1', 'date': '2010-10-10', 'supplier': 'İnvoice A-1', 'nit': '12345678', 'subtotal': '5.00', 'tax': None, 'total': '5.00'}),
+    ('K-FACTURA ﬀ 12\nFECHA ＝ 1/1/2020\nTotal 1.00\n',
+     {'invoice_number': 'URA', 'date': '2020-01-01', 'supplier': 'K-FACTURA ﬀ 12', 'nit': None, 'subtotal': None, 'tax': None, 'total': '1.00'}),
+    ('ǅ factura Ǆ-99\nDate:3-4-2021\nmonto total 7.77\n',
+     {'invoice_number': 'ura', 'date': '2021-04-03', 'supplier': 'ǅ factura Ǆ-99', 'nit': None, 'subtotal': None, 'tax': None, 'total': '7.77'}),
+]
+
+
+def _extract(text):
+    fields = InvoiceExtractor(text, supplier_orgs=[]).extract_all()
+    assert fields.pop("raw_text") == text
+    return fields
+
+
+@pytest.mark.parametrize("text, expected", GOLDEN)
+def test_golden_output(text, expected):
+    assert _extract(text) == expected
+
+
+def _reference_scan(text):
+    """_scan sin prefiltro: ejecuta todas las regex en orden de prioridad"""
+    candidates = {}
+    for field, patterns in FIELD_PATTERNS:
+        for pattern, _ in patterns:
+            match = pattern.search(text)
+            if match:
+                candidates[field] = match.group(1)
+                break
+    return candidates
+
+
+FUZZ_TOKENS = [
+    "factura", "fact.", "invoice", "nº", "no.", "n°", "#", "num.", "fecha", "date", "f.", "emisión",
+    "nit", "ruc", "rfc", "cuit", "tax id", "identificación", "id.", "subtotal", "sub-total",
+    "base imponible", "iva", "tax", "impuesto", "vat", "total", "total a pagar", "importe total",
+    "monto total", "marzo", "diciembre", "de", "ABC-123456", "FE-77", ":", "$", "12/03/2024",
+    "1-2-99", "1.234,56", "100.00", "7,50", "900.123.456-7", "\n", " ", "  ",
+]
+# Caracteres que re.IGNORECASE equipara a letras ASCII de los literales
+FOLDING_VARIANTS = {"i": ("ı", "İ", "I"), "s": ("ſ", "S"), "k": ("\u212a", "K")}
+
+
+def _mutate(token, rng):
+    chars = []
+    for char in token:
+        variants = FOLDING_VARIANTS.get(char.lower())
+        if variants and rng.random() < 0.3:
+            char = rng.choice(variants)
+        elif rng.random() < 0.3:
+            char = char.upper()
+        chars.append(char)
+    return "".join(chars)
+
+
+def _fuzz_texts(count=2000, seed=1234):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield "".join(
+            _mutate(rng.choice(FUZZ_TOKENS), rng) + rng.choice(("", " ", "\n", ": "))
+            for _ in range(rng.randint(3, 30))
+        )
+
+
+def _all_texts():
+    return [text for text, _ in GOLDEN] + list(_fuzz_texts())
+
+
+def test_prefilter_never_skips_a_matching_pattern():
+    for text in _all_texts():
+        folded = _fold(text)
+        for field, patterns in FIELD_PATTERNS:
+            for pattern, literals in patterns:
+                if literals is not None and pattern.search(text):
+                    assert any(lit in folded for lit in literals), (field, pattern.pattern, text)
+
+
+def test_scan_matches_unfiltered_reference():
+    for text in _all_texts():
+        assert InvoiceExtractor(text)._scan() == _reference_scan(text), text
@@ -0,0 +1,121 @@
+"""
+Pruebas del pool de conexiones keep-alive y los reintentos de local_ai_agent
+contra un servidor HTTP de prueba (compatible con /chat/completions) en un
+puerto efímero: varias llamadas deben reutilizar una única conexión y un 5xx
+transitorio debe reintentarse hasta obtener el 200.
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pytest
+
+import local_ai_agent as agent
+
+MESSAGES = [{"role": "user", "content": "hola"}]
+
+
+class StubLMStudio(ThreadingHTTPServer):
+    """Servidor de prueba: responde con la lista de códigos `statuses` y luego 200"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.connections = set()
+        self.requests = 0
+        self.statuses = []
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.requests += 1
+            status = server.statuses.pop(0) if server.statuses else 200
+        if status == 200:
+            body = json.dumps({"choices": [{"message": {"content": f"ok {server.requests}"}}]}).encode()
+        else:
+            body = b"modelo no disponible"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = StubLMStudio()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(agent, "LMSTUDIO_BASE_URL", f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(agent, "LMSTUDIO_BACKOFF", 0.01)
+    monkeypatch.setattr(agent, "LLM_CACHE_ENABLED", False)
+    monkeypatch.setattr(agent, "LLM_LOG", False)
+    # Sesión nueva con el backoff de la prueba
+    monkeypatch.setattr(agent, "_session", None)
+    yield server
+    if agent._session is not None:
+        agent._session.close()
+    server.shutdown()
+    server.server_close()
+
+
+async def _achat_many(count):
+    try:
+        return [await agent._achat(MESSAGES) for _ in range(count)]
+    finally:
+        await agent.aclose_async_client()
+
+
+def test_chat_reuses_one_connection(stub):
+    replies = [agent._chat(MESSAGES) for _ in range(5)]
+    assert replies == [f"ok {n}" for n in range(1, 6)]
+    assert stub.requests == 5
+    assert len(stub.connections) == 1
+
+
+def test_achat_reuses_one_connection(stub):
+    replies = asyncio.run(_achat_many(5))
+    assert replies == [f"ok {n}" for n in range(1, 6)]
+    assert stub.requests == 5
+    assert len(stub.connections) == 1
+
+
+def test_chat_retries_5xx(stub):
+    stub.statuses = [503]
+    assert agent._chat(MESSAGES) == "ok 2"
+    assert stub.requests == 2
+
+
+def test_achat_retries_5xx(stub):
+    stub.statuses = [503]
+    assert asyncio.run(_achat_many(1)) == ["ok 2"]
+    assert stub.requests == 2
+
+
+def test_chat_gives_up_after_retries(stub):
+    stub.statuses = [503] * (agent.LMSTUDIO_RETRIES + 1)
+    with pytest.raises(agent.LocalAIAgentError, match="503"):
+        agent._chat(MESSAGES)
+    assert stub.requests == agent.LMSTUDIO_RETRIES + 1
+
+
+def test_achat_gives_up_after_retries(stub):
+    stub.statuses = [503] * (agent.LMSTUDIO_RETRIES + 1)
+    with pytest.raises(agent.LocalAIAgentError, match="503"):
+        asyncio.run(_achat_many(1))
+    assert stub.requests == agent.LMSTUDIO_RETRIES + 1
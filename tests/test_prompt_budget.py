@@ -0,0 +1,50 @@
+"""
+Pruebas del recorte del texto OCR al presupuesto de tokens del prompt
+(select_relevant_lines).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from local_ai_agent import CHARS_PER_TOKEN, select_relevant_lines
+
+
+def test_short_text_is_unchanged():
+    text = "FACTURA No 1\nTOTAL 10.00"
+    assert select_relevant_lines(text, 100) == text
+
+
+def test_keeps_header_and_field_lines():
+    header = [f"Empresa línea {i}" for i in range(5)]
+    filler = [f"texto sin interés {i}" for i in range(200)]
+    text = "\n".join(header + filler + ["TOTAL A PAGAR", "$ 1.234.567"] + filler)
+    selected = select_relevant_lines(text, 60)
+    lines = selected.splitlines()
+    assert lines[:5] == header
+    assert "TOTAL A PAGAR" in lines and "$ 1.234.567" in lines
+    assert "[...]" in lines
+
+
+def test_single_line_longer_than_budget_is_cut():
+    # Texto sin saltos de línea (capa de texto o texto enviado por el cliente)
+    text = "FACTURA No FE-123 EMPRESA XYZ NIT 900.123.456 " + "Producto A 1000 " * 400
+    max_tokens = 50
+    selected = select_relevant_lines(text, max_tokens)
+    body, marker = selected.rsplit("\n", 1)
+    assert marker == "[...]"
+    assert body.startswith("FACTURA No FE-123 EMPRESA XYZ")
+    assert text.startswith(body)
+    assert len(body) < max_tokens * CHARS_PER_TOKEN
+
+
+def test_long_line_is_cut_to_remaining_budget():
+    header = ["EMPRESA XYZ", "NIT 900.123.456", "FACTURA FE-1", "Fecha 01/02/2024", "Cliente ABC"]
+    long_line = "TOTAL " + "9" * 5000
+    text = "\n".join(header + [long_line])
+    selected = select_relevant_lines(text, 40)
+    lines = selected.splitlines()
+    assert lines[:5] == header
+    assert lines[5].startswith("TOTAL 999") and long_line.startswith(lines[5])
+    assert lines[-1] == "[...]"
+    assert len(selected) <= 40 * CHARS_PER_TOKEN + len("\n[...]")